@@ -2,7 +2,9 @@ import argparse
 import logging
 
 from time import time
-from helpers import readConfig,getSamplesFeatures,readMinimalPheno,readSocialAssistance,readBenefits,readIncome,readPension,getCPI,readMaritalStatus,readPedigree,readLiving,readSES,readEdu,readBirth,readLongterm,readEmigration
+from helpers import readConfig,getSamplesFeatures,getCPI,writeMatrix
+from scheduler import runReaders,runShards
+from perf_report import startStage,endStage,writeReport
 
 def MakeRegFile():
 
@@ -49,163 +51,37 @@ def MakeRegFile():
     #ipython test lines end here
     
     #read in the samples and features to use in the output
-    features,data,ID_set,data_ind_dict = getSamplesFeatures(params)
+    #the time, row counts and memory use of each stage are saved to the performance report
+    stage = startStage(params,'Samples')
+    features,data,ID_set,row_index = getSamplesFeatures(params)
     requested_features = set(features['variable_name'])
     logging.info('Samples and features read in.')
     
     #read in the consumer price index table
     cpi = getCPI(params)
-
-    #then reading in one data source at a time
-
-    #########
-    #PENSION#
-    #########
-    
-    #This step can be skipped if no variables from pension registry are requested
-    pension_set = set(['received_disability_pension','received_pension','total_income','total_pension'])
-    if len(requested_features.intersection(pension_set))>0:
-        data = readPension(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Pension data read in.')
-    else: logging.info('Pension data not read as no pension-related features were requested.')
-
-    ########
-    #INCOME#
-    ########
-
-    #Skipped if no variables needing income information are requested
-    income_set = set(['total_income','received_labor_income','total_labor_income'])
-    if len(requested_features.intersection(income_set))>0:
-        data = readIncome(data,params,requested_features,ID_set,data_ind_dict)
-        logging.info('Income data read in.')
-    else: logging.info('Income data not read as no income-related features were requested.')
-
-    ##########
-    #BENEFITS#
-    ##########
-
-    #Skipped if no variables needing income information are requested
-    benefits_set = set(['received_unemployment_allowance','received_study_allowance',
-                        'received_sickness_allowance','received_basic_unemployment_allowance',
-                        'received_maternity_paternity_parental_allowance'])
-    if len(requested_features.intersection(benefits_set))>0:
-        data = readBenefits(data,params,requested_features,ID_set,data_ind_dict)
-        logging.info('Benefits data read in.')
-    else: logging.info('Benefits data not read as no benefits-related features were requested.')
-
-    ###################
-    #SOCIAL ASSISTANCE#
-    ###################
-
-    #Skipped if no variables needing income information are requested
-    sa_set = set(['total_income','received_any_income_support','total_benefits'])
-    if len(requested_features.intersection(sa_set))>0:
-        data = readSocialAssistance(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Social assistance data read in.')
-    else: logging.info('Social assistance data not read as no social assistance-related features were requested.')
-
-    ############
-    #EMIGRATION#
-    ############
-
-    #Skipped if emigration variable is not requested
-    emi_set = set(['emigrated'])
-    if len(requested_features.intersection(emi_set))>0:
-        data = readEmigration(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Emigration data read in.')
-    else: logging.info('Emigration data not read as emigration variable was not requested.')
-
-    ##################
-    #MARRIAGE HISTORY#
-    ##################
-
-    #Skipped if no variables needing marital status information are requested
-    ms_set = set(['divorced','married'])
-    if len(requested_features.intersection(ms_set))>0:
-        data = readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Marital status data read in.')
-    else: logging.info('Marital status data not read as no marital status-related features were requested.')
-
-    ##########
-    #CHILDREN#
-    ##########
-
-    #Skipped if no variables needing information about children are requested
-    ch_set = set(['children'])
-    if len(requested_features.intersection(ch_set))>0:
-        data = readPedigree(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Pedigree read in.')
-    else: logging.info('Pedigree not read as no pedigree-related features were requested.')
-
-    ####################
-    #PLACE OF RESIDENCE#
-    ####################
-
-    #Skipped if no variables needing information about place of residence are requested
-    ch_set = set(['zip_code','urbanization_class','urban_rural_class_code','sparse_small_house_area','apartment_building_area','small_house_area','demographic_dependency_ratio','economic_dependency_ratio','general_at_risk_of_poverty_rate_for_the_municipality','intermunicipal_net_migration_1000_inhabitants','sale_of_alcoholic_beverages_per_capita','self_rated_health_moderate_or_poor_scaled_health_and_welfare_indicator','average_income_of_inhabitants','median_income_of_inhabitants','permanent_residents_fraction'])
-    if len(requested_features.intersection(ch_set))>0:
-        data = readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Place of residence data read in.')
-    else: logging.info('Place of residence data not read as no place of residence-related features were requested.')
-
-    ######################
-    #SOCIOECONOMIC STATUS#
-    ######################
-
-    #Skipped if no variables needing information about socioeconomic status are requested
-    ses_set = set(['ses_self_employed','ses_upperlevel','ses_lowerlevel','ses_manual_workers','ses_students','ses_pensioners','ses_others','ses_unknown','ses_missing'])
-    if len(requested_features.intersection(ses_set))>0:
-        data = readSES(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Socioeconomic status data read in.')
-    else: logging.info('Socioeconomic data not read as no socioeconomic features were requested.')
-
-
-    ###########
-    #EDUCATION#
-    ###########
-
-    #Skipped if no variables needing information about education are requested
-    edu_set = set(['edu_years','edu_ongoing','edufield_generic','edufield_education','edufield_artshum','edufield_socialsciences','edufield_businessadminlaw','edufield_science_math_stat','edufield_ict','edufield_engineering','edufield_agriculture','edufield_health','edufield_services','edufield_NA'])
-    if len(requested_features.intersection(edu_set))>0:
-        data = readEdu(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Education data read in.')
-    else: logging.info('Education data not read as no education-related features were requested.')
-
-    #######
-    #BIRTH#
-    #######
-
-    #Skipped if no variables needing information about birth and pregnancy are requested
-    birth_set = set(['miscarriages','terminated_pregnancies','ectopic_pregnancies','stillborns','no_smoking_during_pregnancy','quit_smoking_during_1st_trimester','smoked_after_1st_trimester','smoking_during_pregnancy_NA','invitro_fertilization','thrombosis_prophylaxis','anemia','glucose_test_abnormal','no_analgesics','analgesics_info_missing','initiated_labor','promoted_labor','puncture','oxytocin','prostaglandin','extraction_of_placenta','uterine_scraping','suturing','prophylaxis','mother_antibiotics','blood_transfusion','circumcision','hysterectomy','embolisation','vaginal_delivery','vaginal_delivery_breech','forceps_delivery','vacuum_delivery','planned_c_section','urgent_c_section','emergency_c_section','not_planned_c_section','mode_of_delivery_NA','placenta_praevia','ablatio_placentae','eclampsia','shoulder_dystocia','asphyxia','live_born','stillborn_before_delivery','stillborn_during_delivery','stillborn_unknown','birth_status_NA'])
-    if len(requested_features.intersection(birth_set))>0:
-        data = readBirth(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Birth data read in.')
-    else: logging.info('Birth data not read as no birth/pregnancy-related features were requested.')
-
-    ################
-    #LONG-TERM CARE#
-    ################
-
-    #Skipped if no variables needing information about long-term care are requested
-    ltc_set = set(['care_in_elderly_home','assisted_living_elderly','institutional_care_demented','enhanced_care_demented','institutionalized_intellectual_disability','assisted_intellectual_disability','instructed_intellectual_disability','supported_intellectual_disability','services_fos_substance_abusers','rehabilitation','residential_care_housing','psychiatric_residential_care_housing','247_residential_care_housing_under_65yo','247_psychiatric_residential_care','unknown_long_term_care','mr_physical_reasons','mr_insufficient_self_care','mr_deficient_locomotion','mr_nervous_system','mr_forgetfullness','mr_mental_confusion','mr_deficiencies_in_communication','mr_dementia','mr_psychic_social_reasons','mr_depression','mr_other_psychatric','mr_loneliness_insecurity','mr_difficulties_with_housing','mr_lack_of_help_from_family','mr_caretaker_vacation','mr_lack_of_services','mr_lack_of_place_of_care','mr_rehabilitation','mr_med_rehabilitation','mr_accident','mr_somatic','mr_alcohol_use','mr_drug_use','mr_med_abuse','mr_polysubstance_abuse','mr_other_addiction','mr_substance_use_family','mr_NA','long_term_care_decision','long_term_care_duration'])
-    if len(requested_features.intersection(ltc_set))>0:
-        data = readLongterm(data,params,cpi,requested_features,ID_set,data_ind_dict)
-        logging.info('Long-term care data read in.')
-    else: logging.info('Long-term care data not read as no long-term care-related features were requested.')
-    
+    stages = [endStage(params,stage)]
+
+    #then reading in the data sources, independent sources can be read in parallel
+    #(see scheduler.py and the parameter Processes), or the samples can be split into
+    #shards that are processed in parallel (parameter Shards)
+    if int(params.get('Shards',1))>1: data,reader_stages = runShards(data,params,cpi,requested_features)
+    else: data,reader_stages = runReaders(data,params,cpi,requested_features,ID_set,row_index)
+    stages += reader_stages
     
     ########
     #OUTPUT#
     ########
     
     #save the output in the requested format
-    #missing data ouput as '' (empty cells) to save space
-    outname = params['OutputFile']+'-matrix.csv'
-    data.to_csv(outname,sep=',',float_format='%.2f',index=False)
+    stage = startStage(params,'Output')
+    outname = writeMatrix(data,params)
+    stages.append(endStage(params,stage))
     logging.info('Final output matrix saved to: '+outname)
     end = time()
     print("Total running time = "+str(end-start)+" s")
     logging.info("Total running time = "+str(end-start)+" s")
+    outname = writeReport(params,stages,end-start)
+    logging.info('Performance report saved to: '+outname)
 
     
     
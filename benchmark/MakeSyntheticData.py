@@ -0,0 +1,232 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from time import time
+
+#Writes synthetic versions of all the registry files read by MakeRegFile.py, with the
+#same file formats, column names, data types and value codes as the real files, so that
+#MakeRegFile.py can be run and benchmarked outside of the FinRegistry environment.
+#The values are random and do not try to follow the real distributions.
+#
+#The individuals are generated in blocks of --blocksize individuals and each block is
+#appended to the output files, so that memory use does not depend on the number of
+#individuals (e.g. 10k, 1M or 7M). The output is the same for the same --seed and
+#--blocksize.
+
+#socioeconomic status codes used in the SES, social assistance and birth registries
+PSOSE_CODES = ['11','12','21','22','31','32','33','34','41','42','43','44','51','52','53','54','6','70','91','92','93','94','99']
+SOSE_CODES = ['10','11','12','20','21','22','23','24','29','31','32','33','34','39','41','42','43','44','49','51','52','53','54','59','60','61','70','71','72','73','74','79','81','82','83','84','85','91','92','93','94','98','99']
+FALLBACK_SES_CODES = ['11','21','31','32','41','51','6','70','91','99']
+LIVING_RATIO_COLS = ['demographic_dependency_ratio','economic_dependency_ratio','general_at_risk_of_poverty_rate_for_the_municipality','intermunicipal_net_migration_1000_inhabitants','sale_of_alcoholic_beverages_per_capita_as_litres_of_pure_alcohol','self_rated_health_moderate_or_poor_scaled_health_and_welfare_indicator','hr_ktu','hr_mtu','pt_vakiy']
+BIRTH_FLAG_COLS = ['IVF','TROMBOOSIPROF','ANEMIA','SOKERI_PATOL','EI_LIEVITYSTA','EI_LIEVITYS_TIETOA','KAYNNISTYS','EDISTAMINEN','PUHKAISU','OKSITOSIINI','PROSTAGLANDIINI','ISTUKANIRROITUS','KAAVINTA','OMPELU','GBS_PROFYLAKSIA','AIDIN_ANTIBIOOTTIHOITO','VERENSIIRTO','YMPARILEIKKAUKSEN_AVAUS','KOHDUNPOISTO','EMBOLISAATIO','ETINEN','ISTIRTO','RKOURIS','HARTIADYSTOKIA','ASFYKSIA']
+ASSISTANCE_COLS = ['EHKAISEVA_TOIMEENTULOTUKI_EUR','PERUS_TOIMEENTULOTUKI_EUR','TAYD_TOIMEENTULOTUKI_EUR','KUNT_TOIMINTARAHA_EUR','KUNT_MATKAKORVAUS_EUR']
+
+def makeIDs(prefix,first,n):
+    #n FinRegistry-like IDs starting from number first
+    return np.char.add(prefix,np.char.zfill(np.arange(first,first+n).astype(str),7)).astype(object)
+
+def randomIDs(rng,N,n):
+    #n IDs drawn from all N individuals
+    return np.char.add('FR',np.char.zfill((rng.integers(0,N,n)+1).astype(str),7)).astype(object)
+
+def randomDates(rng,n,first_year=1975,last_year=2021):
+    #n random dates (datetime64[D]) between the beginning of first_year and last_year
+    return np.datetime64(str(first_year)+'-01-01')+rng.integers(0,(last_year-first_year)*365,n).astype('timedelta64[D]')
+
+def dateStrings(dates):
+    #dates as yyyy-mm-dd strings, missing dates as NaN
+    out = np.datetime_as_string(dates,unit='D').astype(object)
+    out[np.isnat(dates)] = np.nan
+    return out
+
+def withMissing(rng,values,p):
+    #values as floats with a fraction p of them set to NaN
+    values = np.asarray(values,dtype=float).copy()
+    values[rng.random(len(values))<p] = np.nan
+    return values
+
+def withMissingObject(rng,values,p):
+    #values as objects with a fraction p of them set to NaN
+    values = np.asarray(values).astype(object)
+    values[rng.random(len(values))<p] = np.nan
+    return values
+
+def appendCSV(df,path,first,**kwargs):
+    #write the first block with header, append the others
+    df.to_csv(path,mode='w' if first else 'a',header=first,index=False,**kwargs)
+
+def appendFeather(writers,df,path):
+    #append a block to a feather (arrow IPC) file, the file is opened on the first block
+    table = pa.Table.from_pandas(df,preserve_index=False).replace_schema_metadata(None)
+    if path not in writers: writers[path] = (pa.ipc.new_file(path,table.schema),table.schema)
+    writer,schema = writers[path]
+    writer.write_table(table.cast(schema))
+
+def makeBlock(rng,outdir,N,first,n,writers):
+    #Generate the registry entries of individuals first...first+n-1 and append them to the files
+    #Entries of the other registries are generated in proportion to the block size and
+    #their IDs are drawn from all N individuals.
+    is_first = first==1
+    ids = makeIDs('FR',first,n)
+    dob = np.datetime64('1940-01-01')+rng.integers(0,60*365,n).astype('timedelta64[D]')
+
+    #samples: 90% of individuals are included, 20% of them with two follow-up windows
+    nwin = np.where(rng.random(n)<0.8,1,2)*(rng.random(n)<0.9)
+    ind = np.repeat(np.arange(n),nwin)
+    m = len(ind)
+    starts = (np.datetime64('1985-01-01')+rng.integers(0,25*365,m).astype('timedelta64[D]'))
+    ends = np.minimum(starts+rng.integers(200,12*365,m).astype('timedelta64[D]'),np.datetime64('2021-12-31'))
+    samples = pd.DataFrame({'FINREGISTRYID':ids[ind],'date_of_birth':dateStrings(dob[ind]),'start_of_followup':dateStrings(starts),'end_of_followup':dateStrings(ends)})
+    appendCSV(samples,os.path.join(outdir,'samples.tsv'),is_first,sep='\t')
+
+    #minimal phenotype
+    mpf = pd.DataFrame({'FINREGISTRYID':ids,'SEX':withMissing(rng,rng.integers(0,2,n),0.01),
+                        'MOTHER_TONGUE':rng.choice(['fi','sv','ru','other'],n,p=[.8,.1,.05,.05])})
+    appendFeather(writers,mpf,os.path.join(outdir,'mpf.feather'))
+
+    #pension
+    k = 3*n
+    p_start = randomDates(rng,k)
+    p_end = p_start+rng.integers(30,8000,k).astype('timedelta64[D]')
+    p_end[rng.random(k)<0.3] = np.datetime64('NaT')
+    pension = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'APVM':p_start.astype('datetime64[ns]'),'PPVM':p_end.astype('datetime64[ns]'),
+                            'PTMA':withMissing(rng,rng.uniform(0,2000,k).round(2),.2),'LTMA':withMissing(rng,rng.uniform(0,500,k).round(2),.5),
+                            'JKMA':withMissing(rng,rng.uniform(0,300,k).round(2),.6),'TKSYY1':withMissing(rng,rng.integers(1,9,k),.7)})
+    appendFeather(writers,pension,os.path.join(outdir,'pension.feather'))
+
+    #income
+    k = 10*n
+    income = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'VUOSI':rng.integers(1975,2022,k),
+                           'VUOSIANSIO_INDEXED':np.where(rng.random(k)<.1,0.0,rng.uniform(0,60000,k).round(2))})
+    appendFeather(writers,income,os.path.join(outdir,'income.feather'))
+
+    #unpaid benefits
+    k = 3*n
+    b_start = randomDates(rng,k,1988)
+    benefits = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'ETUUSLAJI':rng.choice([100,101,102,103,120,121,150,210,300,310],k),
+                             'ALKAMISPVM':b_start.astype('datetime64[ns]'),'PAATTYMISPVM':(b_start+rng.integers(1,900,k).astype('timedelta64[D]')).astype('datetime64[ns]')})
+    appendFeather(writers,benefits,os.path.join(outdir,'unpaid.feather'))
+
+    #social assistance
+    k = 2*n
+    assistance = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'TILASTOVUOSI':rng.integers(1987,2022,k)})
+    for col in ASSISTANCE_COLS: assistance[col] = withMissing(rng,rng.uniform(0,3000,k).round(2),.5)
+    assistance['VARS_TOIMEENTULOTUKI_EUR'] = 0
+    assistance['SOSIOEKOASEMA'] = withMissingObject(rng,rng.choice(FALLBACK_SES_CODES,k),.3)
+    appendCSV(assistance,os.path.join(outdir,'assistance.csv'),is_first)
+
+    #relatives (emigration)
+    k = max(n//3,1)
+    relatives = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'EMIGRATION_DATE':withMissingObject(rng,dateStrings(randomDates(rng,k)),.7),
+                              'RELATIVE_ID':randomIDs(rng,N,k)})
+    appendCSV(relatives,os.path.join(outdir,'relatives.csv'),is_first)
+
+    #marriage history
+    k = n
+    m_start = randomDates(rng,k,1960)
+    status = rng.choice([1,2,3,4,5,6,7],k)
+    m_end = dateStrings(m_start+rng.integers(100,15000,k).astype('timedelta64[D]'))
+    m_end[(status==2) & (rng.random(k)<.7)] = np.nan
+    marriages = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'CURRENT_MARITAL_STATUS':status,'START_DATE':dateStrings(m_start),'END_DATE':m_end})
+    appendCSV(marriages,os.path.join(outdir,'marriages.csv'),is_first)
+
+    #pedigree, the children get their own IDs
+    k = n
+    pedigree = pd.DataFrame({'FINREGISTRYID':makeIDs('FC',first,k),'MOTHER_ID':randomIDs(rng,N,k),
+                             'FATHER_ID':withMissingObject(rng,randomIDs(rng,N,k),.1),'BIRTH_DATE':dateStrings(randomDates(rng,k))})
+    appendCSV(pedigree,os.path.join(outdir,'pedigree.csv'),is_first)
+
+    #place of residence
+    k = 4*n
+    l_start = randomDates(rng,k,1970)
+    living = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'Start_of_residence':dateStrings(l_start),
+                           'End_of_residence':withMissingObject(rng,dateStrings(l_start+rng.integers(10,6000,k).astype('timedelta64[D]')),.2),
+                           'posti_alue':rng.choice(['00100','00510','33100','90100','96100'],k),
+                           'TaajamaLuo':rng.choice([1,2,-1],k),'Luokka':rng.choice(['K1','K2','M5','M7'],k)})
+    for col in ['sparse_small_house_area','apartment_building_area','small_house_area']: living[col] = rng.integers(0,2,k)
+    for col in LIVING_RATIO_COLS:
+        values = rng.uniform(0,100,k).round(2)
+        values[rng.random(k)<.05] = -1
+        living[col] = values
+    appendCSV(living,os.path.join(outdir,'dvv_ext_core.csv'),is_first)
+
+    #socioeconomic status, psose is used before 1990 and sose from 1990 onwards
+    k = 3*n
+    years = rng.integers(1970,2021,k)
+    psose = rng.choice(PSOSE_CODES,k).astype(float)
+    sose = rng.choice(SOSE_CODES,k).astype(float)
+    psose[(years>=1990) | (rng.random(k)<.05)] = np.nan
+    sose[(years<1990) | (rng.random(k)<.05)] = np.nan
+    ses = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'vuosi':withMissing(rng,years,.01),'psose':psose,'sose':sose})
+    appendCSV(ses,os.path.join(outdir,'ses.csv'),is_first)
+
+    #education
+    k = 2*n
+    education = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'vuosi':rng.integers(1970,2021,k),
+                              'kaste_t2':withMissingObject(rng,rng.choice(['2','3','4','5','6','7','8','9'],k),.05),
+                              'iscfi2013':rng.choice(['0011','0111','0211','0311','0411','0511','0611','0711','0811','0911','1011','9999'],k)})
+    appendCSV(education,os.path.join(outdir,'education.csv'),is_first,encoding='ISO-8859-1')
+
+    #birth
+    k = n
+    birth = pd.DataFrame({'AITI_FINREGISTRYID':randomIDs(rng,N,k),'TILASTOVUOSI':rng.integers(1987,2021,k),'AITI_IKA':rng.uniform(18,45,k).round(1)})
+    for col in ['KESKENMENOJA','KESKEYTYKSIA','ULKOPUOLISIA','KUOLLEENASYNT']: birth[col] = withMissing(rng,rng.choice([0,0,0,1,2],k),.1)
+    birth['TUPAKOINTITUNNUS'] = rng.choice([1,2,3,4,9],k)
+    for col in BIRTH_FLAG_COLS: birth[col] = withMissing(rng,rng.integers(0,2,k),.05)
+    birth['SYNNYTYSTAPATUNNUS'] = withMissing(rng,rng.integers(1,10,k),.05)
+    birth['SYNTYMATILATUNNUS'] = withMissing(rng,rng.integers(1,5,k),.05)
+    birth['SOSEKO'] = withMissing(rng,rng.choice(FALLBACK_SES_CODES,k).astype(float),.2)
+    appendFeather(writers,birth,os.path.join(outdir,'birth.feather'))
+
+    #long-term care (soshilmo)
+    k = 2*n
+    longterm = pd.DataFrame({'FINREGISTRYID':randomIDs(rng,N,k),'VUOSI':rng.integers(1996,2020,k),
+                             'PALA':withMissingObject(rng,rng.choice(['31.0','32.0','33.0','41.0','5.0','6.0','81.0','85.0','2.0','83.0'],k),.05),
+                             'TUSYY1':withMissingObject(rng,rng.choice(['1','11','12','2','21','24','3','31','"3,2"','4','5','6','71','76'],k),.2),
+                             'PITK':withMissingObject(rng,rng.choice(['K','E','1.0','3.0'],k),.1),
+                             'KVHP':rng.integers(0,366,k)})
+    appendCSV(longterm,os.path.join(outdir,'soshilmo.csv'),is_first,encoding='ISO-8859-1')
+
+def writeCPI(rng,outdir):
+    #consumer price index table for years 1972-2021
+    cpi = pd.DataFrame({'year':range(1972,2022),'cpi':np.round(rng.uniform(1,5,50),4)})
+    cpi.to_csv(os.path.join(outdir,'cpi.csv'),index=False)
+
+def writeConfig(outdir):
+    #MakeRegFile config entries pointing to the synthetic files, without the output entries
+    files = [('MinimalPhenotypeFile','mpf.feather'),('MarriageHistoryFile','marriages.csv'),('PedigreeFile','pedigree.csv'),
+             ('LivingExtendedFile','dvv_ext_core.csv'),('SESFile','ses.csv'),('EducationFile','education.csv'),
+             ('SocialAssistanceFile','assistance.csv'),('BenefitsFile','unpaid.feather'),('PensionFile','pension.feather'),
+             ('IncomeFile','income.feather'),('RelativesFile','relatives.csv'),('SocialHilmoFile','soshilmo.csv'),
+             ('BirthFile','birth.feather'),('SampleFile','samples.tsv'),('CpiFile','cpi.csv')]
+    with open(os.path.join(outdir,'input_config'),'wt') as outfile:
+        for key,name in files: outfile.write(key+'\t'+os.path.abspath(os.path.join(outdir,name))+'\n')
+
+def MakeSyntheticData():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir",help="Directory to write the synthetic registry files to.",type=str,required=True)
+    parser.add_argument("--n",help="Number of individuals (e.g. 10000, 1000000 or 7000000).",type=int,default=10000)
+    parser.add_argument("--seed",help="Random seed.",type=int,default=1)
+    parser.add_argument("--blocksize",help="Number of individuals generated at a time.",type=int,default=100000)
+    args = parser.parse_args()
+
+    start = time()
+    os.makedirs(args.outdir,exist_ok=True)
+    writeCPI(np.random.default_rng(args.seed),args.outdir)
+    writers = {}
+    for first in range(1,args.n+1,args.blocksize):
+        n = min(args.blocksize,args.n-first+1)
+        #each block has its own random stream seeded by the seed and the first individual of the block
+        rng = np.random.default_rng([args.seed,first])
+        makeBlock(rng,args.outdir,args.n,first,n,writers)
+        print("Individuals "+str(first)+"-"+str(first+n-1)+" written in "+str(time()-start)+" s")
+    for writer,schema in writers.values(): writer.close()
+    writeConfig(args.outdir)
+    print("Synthetic registry files written to "+args.outdir+" in "+str(time()-start)+" s")
+
+if __name__=='__main__': MakeSyntheticData()
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import pandas as pd
+
+from time import time
+
+#Runs MakeRegFile.py on a synthetic dataset written by MakeSyntheticData.py in each of the
+#ByYear T/F and OutputAge T/F modes and collects the time of each reader from the
+#performance reports of the runs (OutputFile-perf.json) into one table.
+#The runs are done one after another so that they do not compete for the cores.
+
+MAKEREGFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','MakeRegFile.py')
+FEATUREFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','documents','selected_variables_v2.csv')
+
+def writeConfig(args,outdir,by_year,output_age):
+    #write the MakeRegFile config of one benchmark run, returns the path of the config
+    name = 'ByYear'+by_year+'_OutputAge'+output_age
+    config = os.path.join(outdir,name+'_config')
+    with open(os.path.join(args.datadir,'input_config'),'rt') as infile: lines = infile.read()
+    lines += 'FeatureFile\t'+os.path.abspath(args.featurefile)+'\n'
+    lines += 'OutputFile\t'+os.path.abspath(os.path.join(outdir,name))+'\n'
+    lines += 'ByYear\t'+by_year+'\nOutputEventCount\tF\nOutputBinary\tT\nOutputAge\t'+output_age+'\n'
+    if args.param is not None:
+        for key,value in args.param: lines += key+'\t'+value+'\n'
+    with open(config,'wt') as outfile: outfile.write(lines)
+    return config,os.path.join(outdir,name)
+
+def runMode(args,outdir,by_year,output_age):
+    #run MakeRegFile in one mode, returns the stage entries of the performance report
+    config,outprefix = writeConfig(args,outdir,by_year,output_age)
+    start = time()
+    with open(outprefix+'-stdout.txt','wt') as outfile:
+        subprocess.run([sys.executable,MAKEREGFILE,'--configfile',config,'--logfile',outprefix+'-log.txt'],stdout=outfile,stderr=subprocess.STDOUT,check=True,cwd=os.path.dirname(MAKEREGFILE))
+    end = time()
+    with open(outprefix+'-perf.json','rt') as infile: report = json.load(infile)
+    stages = report['stages']
+    stages.append({'name':'Total','wall_time_s':end-start,'cpu_time_s':None,'peak_rss_mb':report['peak_rss_mb']})
+    for stage in stages:
+        stage['ByYear'] = by_year
+        stage['OutputAge'] = output_age
+    return stages
+
+def RunBenchmark():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datadir",help="Directory with the synthetic registry files written by MakeSyntheticData.py.",type=str,required=True)
+    parser.add_argument("--outdir",help="Directory to write the outputs of the runs and the benchmark table to.",type=str,required=True)
+    parser.add_argument("--modes",help="Comma-separated ByYear+OutputAge modes to run.",type=str,default='FF,FT,TF,TT')
+    parser.add_argument("--featurefile",help="Feature list to use.",type=str,default=FEATUREFILE)
+    parser.add_argument("--param",help="Additional config entry KEY VALUE for MakeRegFile (can be repeated), e.g. --param Processes 4.",nargs=2,action='append')
+    parser.add_argument("--repeats",help="Number of times to run each mode, the fastest run is reported.",type=int,default=1)
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir,exist_ok=True)
+    results = []
+    for mode in args.modes.split(','):
+        by_year,output_age = mode[0],mode[1]
+        runs = []
+        for i in range(args.repeats):
+            runs.append(runMode(args,args.outdir,by_year,output_age))
+            print("ByYear="+by_year+" OutputAge="+output_age+" run "+str(i+1)+" done in "+str(runs[-1][-1]['wall_time_s'])+" s")
+        #keep the fastest run
+        results += min(runs,key=lambda stages: stages[-1]['wall_time_s'])
+
+    results = pd.DataFrame(results)
+    outname = os.path.join(args.outdir,'benchmark.csv')
+    results.to_csv(outname,index=False)
+    #wall time of each stage in each mode
+    table = results.pivot_table(index='name',columns=['ByYear','OutputAge'],values='wall_time_s',sort=False)
+    print(table.round(2).to_string())
+    print("Benchmark results saved to "+outname)
+
+if __name__=='__main__': RunBenchmark()
@@ -8,6 +8,10 @@ from datetime import date
 from time import time
 from collections import Counter
 
+from source_cache import getCacheKey,getEntryPath,readCacheEntry,openCacheEntry,writeCacheChunk,closeCacheEntry
+from perf_report import addCount
+from join_engine import buildRowIndex,buildRowIndexFromKeys,packKeys,getRows,matchRecords,reduceSum,reduceAny,reduceMin,reduceSticky,lastRecord,maxRecord,takeRecords,yearStart,getOnsetAges,getCPIFactors
+
 def readConfig(filepath):
     #Reads in the configuration file.
     #Checks that files provided can be opened.f
@@ -46,11 +50,8 @@ def getSamplesFeatures(params):
     samples['end_of_followup'] = pd.to_datetime(samples['end_of_followup'])
     samples['date_of_birth'] = pd.to_datetime(samples['date_of_birth'])
     #Read in SEX from minimal phenotype file
-    mpfpath = params['MinimalPhenotypeFile']
     usecols = ['FINREGISTRYID','SEX','MOTHER_TONGUE']
-    if mpfpath.count('.feather')>0: mpf = pd.read_feather(mpfpath,columns=usecols)
-    else: mpf = pd.read_csv(mpfpath,usecols=usecols)
-    mpf = mpf[mpf['FINREGISTRYID'].isin(ID_set)]
+    mpf = readSource(params,'MinimalPhenotypeFile',ID_set,usecols=usecols)
     #one-hot encode mother tongues
     mpf = pd.get_dummies(mpf,columns=['MOTHER_TONGUE'])
     
@@ -62,49 +63,16 @@ def getSamplesFeatures(params):
     if params['ByYear']=='F':
         data =  samples.merge(mpf,how='left',on='FINREGISTRYID')
         samples =  samples.merge(mpf[['FINREGISTRYID','SEX']],how='left',on='FINREGISTRYID')
-        data_ind_dict = {} #key = ID, value = [list of indices for this ID]
-        for index,row in data.iterrows():
-            ID = row['FINREGISTRYID']
-            if ID not in data_ind_dict: data_ind_dict[ID] = [index]
-            else: data_ind_dict[ID].append(index)
+        #create the index mapping the IDs to indices of dataframe data
+        row_index = buildRowIndex(data,params)
             
     elif params['ByYear']=='T':
         samples =  samples.merge(mpf[['FINREGISTRYID','SEX']],how='left',on='FINREGISTRYID')
         #mother tongues are not repeated for every year
-        data_ind_dict = {} #key = (FINREGISTRYID,year), value = [list of indices for this ID]
-        samples_ind_dict = {} #key = (FINREGISTRYID,start_of_followup,end_of_followup)
-        data = pd.DataFrame()
-        IDs = []
-        years = []
-        SEXs = []
-        dobs = []
-        starts = []
-        ends = []
-        #create one entry row per each year of follow-up for each individual
-        ind = 0
-        for index,row in samples.iterrows():
-            start_year = row['start_of_followup'].year
-            end_year = row['end_of_followup'].year
-            samples_ind_dict[(row['FINREGISTRYID'],row['start_of_followup'],row['end_of_followup'])] = index
-            for year in range(start_year,end_year+1):
-                IDs.append(row['FINREGISTRYID'])
-                dobs.append(row['date_of_birth'])
-                SEXs.append(row['SEX'])
-                starts.append(row['start_of_followup'])
-                ends.append(row['end_of_followup'])
-                years.append(year)
-                key = (row['FINREGISTRYID'],year)
-                if key not in data_ind_dict: data_ind_dict[key] = [ind]
-                else: data_ind_dict[key].append(ind)
-                ind += 1
-        data['FINREGISTRYID'] = IDs
-        data['year'] = years
-        data['date_of_birth'] = dobs
-        data['SEX'] = SEXs
-        data['start_of_followup'] = starts
-        data['end_of_followup'] = ends
+        #create one entry row per each year of follow-up for each individual, together
+        #with the index mapping the ID+year pairs to indices of dataframe data
+        data,row_index = expandFollowUpYears(samples)
 
-    #create a dictionary mapping the ID+year pairs to indices of dataframe data
     features = pd.read_csv(params['FeatureFile'])
     if params['ByYear']=='F':
         #keys = [(row['FINREGISTRYID'],row['start_of_followup'],row['end_of_followup']) for index,row in data.iterrows()]
@@ -114,13 +82,60 @@ def getSamplesFeatures(params):
         #value = corresponding index in dataframe data
         end = time()
         print("Data structures initialized in "+str(end-start)+" s")
-        return features,data,ID_set,data_ind_dict
+        return features,data,ID_set,row_index
     elif params['ByYear']=='T':
         #samples_ind_dict = dict(zip(list(samples['FINREGISTRYID']),list(samples.index)))
         end = time()
         print("Data structures initialized in "+str(end-start)+" s")
-        return features,data,ID_set,data_ind_dict
+        return features,data,ID_set,row_index
     
+def expandFollowUpYears(samples):
+    #Create one entry row per each year of follow-up for each individual in samples
+    #returns the dataframe data and the index mapping the ID+year pairs to its rows
+    #IDs are stored as categorical and years as int16 to keep the dataframe small
+    start_years = samples['start_of_followup'].dt.year.values
+    end_years = samples['end_of_followup'].dt.year.values
+    nyears = np.maximum(end_years-start_years+1,0)
+    #sample of each row, and the year of the row is the start year of the sample plus
+    #the position of the row within the rows of the sample
+    sample_ind = np.repeat(np.arange(len(samples)),nyears)
+    years = np.arange(nyears.sum())-np.repeat(np.cumsum(nyears)-nyears,nyears)+start_years[sample_ind]
+    codes,uniques = pd.factorize(samples['FINREGISTRYID'],sort=True)
+    codes = codes[sample_ind]
+    data = pd.DataFrame({'FINREGISTRYID':pd.Categorical.from_codes(codes,categories=uniques),
+                         'year':years.astype(np.int16),
+                         'date_of_birth':samples['date_of_birth'].values[sample_ind],
+                         'SEX':samples['SEX'].values[sample_ind],
+                         'start_of_followup':samples['start_of_followup'].values[sample_ind],
+                         'end_of_followup':samples['end_of_followup'].values[sample_ind]})
+    row_index = buildRowIndexFromKeys(uniques,True,packKeys(codes,years))
+    return data,row_index
+
+def writeMatrix(data,params):
+    #Save the output matrix in the format given by params['OutputFormat'] (csv, parquet or feather)
+    #returns the path of the output file
+    #csv: written params['OutputChunkSize'] rows at a time, missing data ouput as '' (empty
+    #cells) to save space and decimal numbers rounded to two decimals
+    #parquet and feather: binary columnar formats that keep the column data types and full
+    #precision, compressed with params['OutputCompression']. The parquet file is written in
+    #row groups of params['ParquetRowGroupSize'] rows.
+    output_format = params.get('OutputFormat','csv')
+    if output_format=='csv':
+        outname = params['OutputFile']+'-matrix.csv'
+        chunksize = int(params.get('OutputChunkSize',100000))
+        with open(outname,'wt',newline='') as outfile:
+            #the header is written also for an empty matrix
+            for i in range(0,max(len(data),1),chunksize):
+                data.iloc[i:i+chunksize].to_csv(outfile,sep=',',float_format='%.2f',index=False,header=i==0)
+    elif output_format=='parquet':
+        outname = params['OutputFile']+'-matrix.parquet'
+        data.to_parquet(outname,engine='pyarrow',index=False,compression=params.get('OutputCompression','zstd'),row_group_size=int(params.get('ParquetRowGroupSize',1000000)))
+    elif output_format=='feather':
+        outname = params['OutputFile']+'-matrix.feather'
+        data.reset_index(drop=True).to_feather(outname,compression=params.get('OutputCompression','zstd'))
+    else: raise ValueError("Unknown OutputFormat "+output_format+", use csv, parquet or feather.")
+    return outname
+
 def getCPI(params):
     #Read in the consumer price index correction table
     with open(params['CpiFile'],'rt') as infile:
@@ -131,6 +146,75 @@ def getCPI(params):
             cpi[int(row[0])] = float(row[1])
     return cpi
     
+def readSource(params,key,ID_set,ID_cols=['FINREGISTRYID'],dates=[],**kwargs):
+    #Read in the source registry file params[key] (csv or feather) keeping only the rows
+    #where any of ID_cols is in ID_set, and convert the columns in dates to datetime.
+    #kwargs are passed to pd.read_csv, usecols is also used for feather files.
+    #If params['ChunkSize'] is set, csv files are streamed in chunks of that many rows and
+    #each chunk is filtered and converted before it is added to the output, so that the
+    #whole file is never held in memory at once. Otherwise the file is read in at once.
+    #If params['CacheDir'] is set, the parsed file is stored in and later read from the
+    #cache instead of parsing it again (see source_cache.py).
+    if 'CacheDir' in params: chunks = readCachedSourceChunks(params,key,dates,kwargs)
+    else: chunks = readSourceChunks(params,key,kwargs)
+    out = []
+    for chunk in chunks:
+        addCount('rows_read',len(chunk))
+        chunk = filterSourceChunk(chunk,ID_set,ID_cols)
+        addCount('rows_kept',len(chunk))
+        #convert date columns to datetime, cached chunks are already converted
+        for col in dates: chunk[col] = pd.to_datetime(chunk[col])
+        out.append(chunk)
+    if len(out)==1: return out[0]
+    return pd.concat(out)
+
+def readSourceChunks(params,key,kwargs):
+    #yield the source file params[key] in chunks, or as one chunk if params['ChunkSize'] is not set
+    path = params[key]
+    if path.count('.feather')>0:
+        yield renameIDColumn(pd.read_feather(path,columns=kwargs.get('usecols')))
+        return
+    chunksize = int(params.get('ChunkSize',0))
+    if chunksize>0: chunks = pd.read_csv(path,chunksize=chunksize,**kwargs)
+    else: chunks = [pd.read_csv(path,**kwargs)]
+    nchunks = 0
+    for chunk in chunks:
+        nchunks += 1
+        yield renameIDColumn(chunk)
+    #a file without data rows gives no chunks
+    if nchunks==0: yield renameIDColumn(pd.read_csv(path,nrows=0,**kwargs))
+
+def readCachedSourceChunks(params,key,dates,kwargs):
+    #yield the chunks of source file params[key] from the cache, or if the file is not in
+    #the cache, parse the file, convert the dates and add the chunks to the cache
+    path = params[key]
+    if path.count('.feather')>0: columns = kwargs.get('usecols')
+    else: columns = list(pd.read_csv(path,nrows=0,**kwargs).columns)
+    cache_key,family_key = getCacheKey(params,path,columns,dates,kwargs)
+    if params.get('CacheRefresh','F')!='T':
+        chunks = readCacheEntry(getEntryPath(params,cache_key))
+        if chunks is not None:
+            print("Reading "+path+" from cache")
+            for chunk in chunks: yield chunk
+            return
+    writer = openCacheEntry(params,cache_key,family_key,path)
+    for chunk in readSourceChunks(params,key,kwargs):
+        for col in dates: chunk[col] = pd.to_datetime(chunk[col])
+        writeCacheChunk(writer,chunk)
+        yield chunk
+    closeCacheEntry(params,writer)
+
+def renameIDColumn(chunk):
+    #depending on the version, some source files have some column names in uppercase, some in lowercase
+    if 'FINREGISTRYID' not in chunk.columns and 'finregistryid' in chunk.columns: chunk = chunk.rename(columns={'finregistryid':'FINREGISTRYID'})
+    return chunk
+
+def filterSourceChunk(chunk,ID_set,ID_cols):
+    #keep only rows of chunk where any of ID_cols is in ID_set
+    keep = np.zeros(len(chunk),dtype=bool)
+    for col in ID_cols: keep |= chunk[col].isin(ID_set).values
+    return chunk[keep].copy()
+
 def testFileOpens(filepath,mode='r'):
 
     error = False
@@ -162,7 +246,7 @@ def readMinimalPheno(params,data):
         data['SEX'] = SEXs
         return data
 
-def readPension(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readPension(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the variables from the pension registry
     #this function currently creates four variables, which are:
     #received_disability_pension = Received disability pension
@@ -171,13 +255,9 @@ def readPension(data,params,cpi,requested_features,ID_set,data_ind_dict):
     #total_income = Sum of labor income, pension and social benefits, indexed
     start = time()
     keep_cols = ['FINREGISTRYID','APVM','PPVM','PTMA','LTMA','JKMA','TKSYY1']
-    pension = pd.read_feather(params['PensionFile'],columns=keep_cols)
-    #keep only rows corresponding to IDs in samples
-    pension = pension[pension['FINREGISTRYID'].isin(ID_set)]
+    #keep only rows corresponding to IDs in samples and convert date strings to datetime
+    pension = readSource(params,'PensionFile',ID_set,dates=['APVM','PPVM'],usecols=keep_cols)
     print("Pension, number or data rows: "+str(len(pension)))
-    #convert date strings to datetime
-    pension['APVM'] = pd.to_datetime(pension['APVM'])
-    pension['PPVM'] = pd.to_datetime(pension['PPVM'])
 
     received_disability_pension = [0 for i in range(len(data))]
     received_pension = [0 for i in range(len(data))]
@@ -205,10 +285,8 @@ def readPension(data,params,cpi,requested_features,ID_set,data_ind_dict):
             #print(p_row)
             years = [a for a in range(int(p_start.year),int(p_end.year)+1)]
             for year in years:
-                key = (ID,year)
                 #check if this ID+year combo is requested
-                if key not in data_ind_dict: continue
-                for ind in data_ind_dict[key]:
+                for ind in getRows(row_index,ID,year):
                     #correct for start and end years not necessarily being full years
                     nmonths = 12
                     if year==p_start.year: nmonths = 13-p_start.month
@@ -242,8 +320,7 @@ def readPension(data,params,cpi,requested_features,ID_set,data_ind_dict):
                                 if received_disability_pension[ind]: received_disability_pension_OnsetAge[ind] = OnsetAge
             
         elif params['ByYear']=='F':
-            key = ID
-            for ind in data_ind_dict[key]:
+            for ind in getRows(row_index,ID):
                 fu_end = data.iloc[ind]['end_of_followup']
                 fu_start = data.iloc[ind]['start_of_followup']
                 dob = data.iloc[ind]['date_of_birth']
@@ -310,7 +387,7 @@ def readPension(data,params,cpi,requested_features,ID_set,data_ind_dict):
     print("Pension data preprocessed in "+str(end-start)+" s")
     return data
                 
-def readIncome(data,params,requested_features,ID_set,data_ind_dict):
+def readIncome(data,params,requested_features,ID_set,row_index):
     #Read in the variables from the pension registry
     #this function currently creates three variables, which are:
     #received_labor_income = Received labor income
@@ -318,46 +395,25 @@ def readIncome(data,params,requested_features,ID_set,data_ind_dict):
     #total_labor_income = Sum of labor income, indexed
     start = time()
     keep_cols = ['FINREGISTRYID','VUOSI','VUOSIANSIO_INDEXED']
-    income = pd.read_feather(params['IncomeFile'],columns=keep_cols)
     #keep only rows corresponding to IDs in samples
-    income = income[income['FINREGISTRYID'].isin(ID_set)]
+    income = readSource(params,'IncomeFile',ID_set,usecols=keep_cols)
     print("Income, number or data rows: "+str(len(income)))
     
     #Note that the dataframe 'data' has already been initialized, so depending on the
     #value of params['ByYear'], it either contains one entry per ID, or one entry per ID
     #per year.
     #Also the variable 'total_income' is already in data
-    labor_income = [0 for i in range(len(data))]
-    received_labor_income = [0 for i in range(len(data))]
-    if params['OutputAge']=='T': received_labor_income_OnsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in income.iterrows():
-        ID = row['FINREGISTRYID']
-        year = row['VUOSI']
-
-        if params['ByYear']=='T':
-            key = (ID,year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #if year is outside the follow-up for this ID, skip
-            if year<fu_start.year or year>fu_end.year: continue
-            income_value = row['VUOSIANSIO_INDEXED']
-        
-            #update the values
-            #if params['ByYear']=='T': ind = data_ind_dict[(ID,fu_start,fu_end,year)]
-            #else: ind = data_ind_dict[(ID,fu_start,fu_end)]
-            labor_income[ind] += income_value
-            if income_value>0: received_labor_income[ind] = 1
-            #and the onset ages if requested
-            if params['OutputAge']=='T':
-                dob = data.iloc[ind]['date_of_birth']
-                OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                if np.isnan(received_labor_income_OnsetAge[ind]): received_labor_income_OnsetAge[ind] = OnsetAge
-                elif received_labor_income_OnsetAge[ind]>OnsetAge: received_labor_income_OnsetAge[ind] = OnsetAge
+    #match each income entry to the rows of data whose follow-up covers the year
+    years = income['VUOSI'].values
+    src,ind = matchRecords(data,params,row_index,income['FINREGISTRYID'].values,years=years)
+    income_value = income['VUOSIANSIO_INDEXED'].values[src]
+    labor_income = reduceSum(ind,income_value,len(data))
+    received_labor_income = reduceAny(ind,income_value>0,len(data))
+    #and the onset ages if requested
+    if params['OutputAge']=='T':
+        dob = data['date_of_birth'].values[ind]
+        OnsetAge = getOnsetAges(dob,yearStart(years[src]))
+        received_labor_income_OnsetAge = reduceMin(ind,OnsetAge,len(data))
     #Add the new columns to data
     if 'total_income' in requested_features:
         data['total_income'] = data['total_income'].add(labor_income,axis='index')
@@ -371,7 +427,7 @@ def readIncome(data,params,requested_features,ID_set,data_ind_dict):
     print('Income data read in in '+str(end-start)+" s")
     return data
 
-def readBenefits(data,params,requested_features,ID_set,data_ind_dict):
+def readBenefits(data,params,requested_features,ID_set,row_index):
     #Read in the variables from the pension registry
     #this function currently creates six variables, which are:
     #received_unemployment_allowance = Received earnings-related unemployment allowance
@@ -383,13 +439,9 @@ def readBenefits(data,params,requested_features,ID_set,data_ind_dict):
     
     start = time()
     keep_cols = ['FINREGISTRYID','ETUUSLAJI','ALKAMISPVM','PAATTYMISPVM']
-    benefits = pd.read_feather(params['BenefitsFile'],columns=keep_cols)
-    #keep only rows corresponding to IDs in samples
-    benefits = benefits[benefits['FINREGISTRYID'].isin(ID_set)]
+    #keep only rows corresponding to IDs in samples and convert the dates to datetime
+    benefits = readSource(params,'BenefitsFile',ID_set,dates=['ALKAMISPVM','PAATTYMISPVM'],usecols=keep_cols)
     print("Benefits, number or data rows: "+str(len(benefits)))
-    #convert the dates to datetime
-    benefits['ALKAMISPVM'] = pd.to_datetime(benefits['ALKAMISPVM'])
-    benefits['PAATTYMISPVM'] = pd.to_datetime(benefits['PAATTYMISPVM'])
     #Note that the dataframe 'data' has already been initialized, so depending on the
     #value of params['ByYear'], it either contains one entry per ID, or one entry per ID
     #per year.
@@ -432,8 +484,7 @@ def readBenefits(data,params,requested_features,ID_set,data_ind_dict):
         else: benefit_var = 'received_other_allowance'
 
         if params['ByYear']=='F':
-            key = ID
-            for ind in data_ind_dict[key]:
+            for ind in getRows(row_index,ID):
                 fu_end = data.iloc[ind]['end_of_followup']
                 fu_start = data.iloc[ind]['start_of_followup']
                 #if the benefit period is outside the follow-up for this ID, skip
@@ -458,10 +509,8 @@ def readBenefits(data,params,requested_features,ID_set,data_ind_dict):
             if np.isnan(b_start.year) or np.isnan(b_end.year): continue
             years = [a for a in range(b_start.year,b_end.year+1)]
             for year in years:
-                key = (ID,year)
                 #if year is outside of follow-up, skip this year
-                if key not in data_ind_dict: continue
-                for ind in data_ind_dict[key]:
+                for ind in getRows(row_index,ID,year):
                     #update the values
                     new_cols[benefit_var][ind] = 1
                     #and the onset ages if requested
@@ -482,7 +531,7 @@ def readBenefits(data,params,requested_features,ID_set,data_ind_dict):
     print('Benefits data read in in '+str(end-start)+" s")
     return data
 
-def readSocialAssistance(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readSocialAssistance(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the variables from the social assistance registry
     #this function currently creates three variables, which are:
     #received_any_income_support = Received basic, actual, preventive or complementary income support
@@ -492,9 +541,8 @@ def readSocialAssistance(data,params,cpi,requested_features,ID_set,data_ind_dict
     start = time()
     keep_cols = ['FINREGISTRYID','TILASTOVUOSI','EHKAISEVA_TOIMEENTULOTUKI_EUR','PERUS_TOIMEENTULOTUKI_EUR','TAYD_TOIMEENTULOTUKI_EUR','KUNT_TOIMINTARAHA_EUR','KUNT_MATKAKORVAUS_EUR']
     #Note that column VARS_TOIMEENTULOTUKI_EUR seems to be sum of all other forms of income support except EHKAISEVA_TOIMEENTULOTUKI_EUR, that is why it is not used to avoid counting some of the income support twice
-    assistance = pd.read_csv(params['SocialAssistanceFile'],usecols=keep_cols,sep=',')
     #keep only rows corresponding to IDs in samples
-    assistance = assistance[assistance['FINREGISTRYID'].isin(ID_set)]
+    assistance = readSource(params,'SocialAssistanceFile',ID_set,usecols=keep_cols,sep=',')
     print("Social assistance, number or data rows: "+str(len(assistance)))
     sum_cols = list(assistance)
     sum_cols.remove('FINREGISTRYID')
@@ -506,39 +554,18 @@ def readSocialAssistance(data,params,cpi,requested_features,ID_set,data_ind_dict
     #value of params['ByYear'], it either contains one entry per ID, or one entry per ID
     #per year.
     #Also the variable 'total_income' is already in data
-    received_any_income_support = [0 for i in range(len(data))]
-    support_income = [0 for i in range(len(data))]
-    if params['OutputAge']=='T': received_any_income_support_OnsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in assistance.iterrows():
-        ID = row['FINREGISTRYID']
-        year = row['TILASTOVUOSI']
-        if params['ByYear']=='F': key = ID
-        elif params['ByYear']=='T':
-            key = (ID,year)
-            #if the year is not within follow-up, skip this entry
-            if key not in data_ind_dict: continue
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #if year is outside the follow-up for this ID, skip
-            if year<fu_start.year or year>fu_end.year: continue
-
-            if year not in cpi: C = cpi[1972]
-            else: C = cpi[year]
-        
-            income_value = row['tot_income_support']*C #multiply with the consumer price index
-            #if params['ByYear']=='T': ind = data_ind_dict[(ID,fu_start,fu_end,year)]
-            #else: ind = data_ind_dict[(ID,fu_start,fu_end)]
-            #update the values
-            support_income[ind] += income_value
-            if income_value>0: received_any_income_support[ind] = 1
-            #and the onset ages if requested
-            if params['OutputAge']=='T':
-                dob = data.iloc[ind]['date_of_birth']
-                OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                if np.isnan(received_any_income_support_OnsetAge[ind]): received_any_income_support_OnsetAge[ind] = OnsetAge
-                elif received_any_income_support_OnsetAge[ind]>OnsetAge: received_any_income_support_OnsetAge[ind] = OnsetAge
+    #match each entry to the rows of data whose follow-up covers the year
+    years = assistance['TILASTOVUOSI'].values
+    src,ind = matchRecords(data,params,row_index,assistance['FINREGISTRYID'].values,years=years)
+    #multiply with the consumer price index
+    income_value = assistance['tot_income_support'].values[src]*getCPIFactors(cpi,years[src])
+    support_income = reduceSum(ind,income_value,len(data))
+    received_any_income_support = reduceAny(ind,income_value>0,len(data))
+    #and the onset ages if requested
+    if params['OutputAge']=='T':
+        dob = data['date_of_birth'].values[ind]
+        OnsetAge = getOnsetAges(dob,yearStart(years[src]))
+        received_any_income_support_OnsetAge = reduceMin(ind,OnsetAge,len(data))
 
     #add the newly preprocessed values to data
     if 'total_income' in requested_features:
@@ -553,48 +580,29 @@ def readSocialAssistance(data,params,cpi,requested_features,ID_set,data_ind_dict
     print('Social assistance data read in in '+str(end-start)+" s")
     return data
 
-def readEmigration(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readEmigration(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the emigration variable from the DVV relatives
     #this function currently creates one variable, which is:
     #emigrated = Whether the individual has emigrated; 0=no, 1=yes
     
     start = time()
     keep_cols = ['FINREGISTRYID','EMIGRATION_DATE']
-    relatives = pd.read_csv(params['RelativesFile'],usecols=keep_cols,sep=',')
+    #keep only rows corresponding to IDs in samples and convert date columns to datetime
+    relatives = readSource(params,'RelativesFile',ID_set,dates=['EMIGRATION_DATE'],usecols=keep_cols,sep=',')
     #keep only rows where EMIGRATION_DATE is not missing
     relatives = relatives.loc[~relatives['EMIGRATION_DATE'].isnull()]
-    #keep only rows corresponding to IDs in samples
-    relatives = relatives[relatives['FINREGISTRYID'].isin(ID_set)]
-    #convert date columns to datetime
-    relatives['EMIGRATION_DATE'] = pd.to_datetime(relatives['EMIGRATION_DATE'])
     
     print("Emigration, number or data rows: "+str(len(relatives)))
 
-    #initialize the new columns
-    emigrated = [0 for i in range(len(data))]
-    if params['OutputAge']=='T': emigrated_onsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in relatives.iterrows():
-        ID = row['FINREGISTRYID']
-        EMIGRATION_DATE = row['EMIGRATION_DATE']
-        if params['ByYear']=='T':
-            key = (ID,EMIGRATION_DATE.year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-
-        
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #skip if emigration date is outside of follow-up for this entry
-            if EMIGRATION_DATE<fu_start or EMIGRATION_DATE>fu_end: continue
-
-            emigrated[ind] = 1
-            #check if age at emigration is requested
-            if params['OutputAge']=='T':
-                dob = data.iloc[ind]['date_of_birth']
-                onsetAge = getOnsetAge(dob,EMIGRATION_DATE)
-                emigrated_onsetAge[ind] = onsetAge
+    #match each emigration to the rows of data whose follow-up contains the emigration date
+    dates = relatives['EMIGRATION_DATE'].values
+    src,ind = matchRecords(data,params,row_index,relatives['FINREGISTRYID'].values,dates=dates)
+    emigrated = reduceAny(ind,np.ones(len(ind),dtype=bool),len(data))
+    #check if age at emigration is requested
+    if params['OutputAge']=='T':
+        #age at the last emigration within the follow-up
+        OnsetAge = getOnsetAges(data['date_of_birth'].values[ind],dates[src])
+        emigrated_onsetAge = takeRecords(OnsetAge,lastRecord(np.arange(len(ind)),ind,len(data)),np.nan)
     #add the new columns to data
     data['emigrated'] = emigrated
 
@@ -606,7 +614,7 @@ def readEmigration(data,params,cpi,requested_features,ID_set,data_ind_dict):
     return data
 
 
-def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readMaritalStatus(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the variables from the DVV marriage history
     #this function currently creates two variables, which are:
     #divorced = Whether the individual has divorced; 0=no, 1=yes
@@ -614,15 +622,11 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
     
     start = time()
     keep_cols = ['FINREGISTRYID','CURRENT_MARITAL_STATUS','START_DATE','END_DATE']
-    marriage = pd.read_csv(params['MarriageHistoryFile'],usecols=keep_cols,sep=',')
-    #keep only rows corresponding to IDs in samples
-    marriage = marriage[marriage['FINREGISTRYID'].isin(ID_set)]
+    #keep only rows corresponding to IDs in samples and convert date columns to datetime
+    marriage = readSource(params,'MarriageHistoryFile',ID_set,dates=['START_DATE','END_DATE'],usecols=keep_cols,sep=',')
     #keep only rows corresponding to current marital status being either married or divorced,
     #also include registered partnerships
     marriage = marriage.loc[(marriage['CURRENT_MARITAL_STATUS']==2) | (marriage['CURRENT_MARITAL_STATUS']==4) | (marriage['CURRENT_MARITAL_STATUS']==6) | (marriage['CURRENT_MARITAL_STATUS']==7)]
-    #convert date columns to datetime
-    marriage['START_DATE'] = pd.to_datetime(marriage['START_DATE'])
-    marriage['END_DATE'] = pd.to_datetime(marriage['END_DATE'])
     
     print("Marriage history, number or data rows: "+str(len(marriage)))
 
@@ -645,8 +649,7 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
         else: divorce_date = None
 
         if params['ByYear']=='F':
-            key = ID
-            for ind in data_ind_dict[key]:
+            for ind in getRows(row_index,ID):
                 fu_end = data.iloc[ind]['end_of_followup']
                 fu_start = data.iloc[ind]['start_of_followup']
                 #if the marriage period is completely outside the follow-up for this ID, skip
@@ -685,10 +688,7 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
             if pd.isnull(m_end): m_end = date.today()
             #print(row)
             for year in range(m_start.year,m_end.year+1):
-                key = (ID,year)
-                if key not in data_ind_dict: continue
-
-                for m_ind in data_ind_dict[key]:
+                for m_ind in getRows(row_index,ID,year):
                     if m_start==marriage_date:
                         #m_ind = data_ind_dict[(ID,fu_start,fu_end,marriage_date.year)]
                         #update the values
@@ -697,10 +697,9 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
                         married[m_ind] = 1
                         #if divorce_date is not None:
                         if divorce_date==m_end:
-                            d_key = (ID,divorce_date.year)
-                            #d_ind = data_ind_dict[(ID,fu_start,fu_end,divorce_date.year)]
-                            if d_key in data_ind_dict:
-                                for d_ind in data_ind_dict[d_key]: divorced[d_ind] = 1
+                            d_rows = getRows(row_index,ID,divorce_date.year)
+                            if len(d_rows)>0:
+                                for d_ind in d_rows: divorced[d_ind] = 1
                                 #and the onset ages if requested
                                 if params['OutputAge']=='T':
                                     dob = data.iloc[m_ind]['date_of_birth']
@@ -711,9 +710,7 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
                                         #only count the divorce if it happens this year
                                         if divorce_date==m_end:
                                             OnsetAge = getOnsetAge(dob,divorce_date)
-                                            d_key = (ID,divorce_date.year)
-                                            if d_key in data_ind_dict:
-                                                for d_ind in data_ind_dict[d_key]:
+                                            for d_ind in d_rows:
                                                     if np.isnan(divorced_OnsetAge[d_ind]): divorced_OnsetAge[d_ind] = OnsetAge
                                                     elif divorced_OnsetAge[d_ind]>OnsetAge: divorced_OnsetAge[d_ind] = OnsetAge
                         
@@ -729,18 +726,15 @@ def readMaritalStatus(data,params,cpi,requested_features,ID_set,data_ind_dict):
     print('Marital status data read in in '+str(end-start)+" s")
     return data
 
-def readPedigree(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readPedigree(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the variables from the FinRegistry pedigree
     #this function currently creates one variables, which is:
     #children = Whether the individual has children.
     
     start = time()
     keep_cols = ['FINREGISTRYID','MOTHER_ID','FATHER_ID','BIRTH_DATE']
-    pedigree = pd.read_csv(params['PedigreeFile'],usecols=keep_cols,sep=',')
-    #keep only rows corresponding to IDs in samples
-    pedigree = pedigree[(pedigree['MOTHER_ID'].isin(ID_set)) | (pedigree['FATHER_ID'].isin(ID_set))]
-    #convert date columns to datetime
-    pedigree['BIRTH_DATE'] = pd.to_datetime(pedigree['BIRTH_DATE'])
+    #keep only rows where either parent is in samples and convert date columns to datetime
+    pedigree = readSource(params,'PedigreeFile',ID_set,ID_cols=['MOTHER_ID','FATHER_ID'],dates=['BIRTH_DATE'],usecols=keep_cols,sep=',')
     #convert nans to empty strings
     pedigree.fillna('',inplace=True)
     
@@ -764,13 +758,11 @@ def readPedigree(data,params,cpi,requested_features,ID_set,data_ind_dict):
         child_dob = row['BIRTH_DATE']
         
         for ID in parent_IDs:
-            if params['ByYear']=='F': key = ID
-            elif params['ByYear']=='T':
-                key = (ID,child_dob.year)
-                #if child is born outside of follow-up for this parent, skip the child
-                if key not in data_ind_dict: continue
+            if params['ByYear']=='F': rows = getRows(row_index,ID)
+            #if child is born outside of follow-up for this parent, there are no rows for the child
+            elif params['ByYear']=='T': rows = getRows(row_index,ID,child_dob.year)
 
-            for ind in data_ind_dict[key]:
+            for ind in rows:
                 fu_end = data.iloc[ind]['end_of_followup']
                 fu_start = data.iloc[ind]['start_of_followup']
                 if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
@@ -799,7 +791,7 @@ def readPedigree(data,params,cpi,requested_features,ID_set,data_ind_dict):
 
     return data
 
-def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readLiving(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the variables from the DVV living extended
     #this function currently creates 13 variables, which are:
     #zip_code = Zip code of place of residence
@@ -820,12 +812,8 @@ def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
     start = time()
     #first read in the dvv_ext_core for individuals' information
     keep_cols = ['FINREGISTRYID','Start_of_residence','End_of_residence','posti_alue','TaajamaLuo','Luokka','sparse_small_house_area','apartment_building_area','small_house_area','demographic_dependency_ratio','economic_dependency_ratio','general_at_risk_of_poverty_rate_for_the_municipality','intermunicipal_net_migration_1000_inhabitants','sale_of_alcoholic_beverages_per_capita_as_litres_of_pure_alcohol','self_rated_health_moderate_or_poor_scaled_health_and_welfare_indicator','hr_ktu','hr_mtu','pt_vakiy']
-    living = pd.read_csv(params['LivingExtendedFile'],usecols=keep_cols,sep=',',dtype={'posti_alue':str})
-    #remove entries for IDs that are not in the study population
-    living = living[living['FINREGISTRYID'].isin(ID_set)]
-    #convert date columns to datetime
-    living['Start_of_residence'] = pd.to_datetime(living['Start_of_residence'])
-    living['End_of_residence'] = pd.to_datetime(living['End_of_residence'])
+    #remove entries for IDs that are not in the study population and convert date columns to datetime
+    living = readSource(params,'LivingExtendedFile',ID_set,dates=['Start_of_residence','End_of_residence'],usecols=keep_cols,sep=',',dtype={'posti_alue':str})
     #fill missing end dates of residence with today, assuming missing end date means
     #that the residence still continues in this address
     living['End_of_residence'] = living['End_of_residence'].fillna(datetime.now())
@@ -840,7 +828,7 @@ def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
     living.replace(to_replace=-1,value=np.nan,inplace=True)
     #sort the dataframe living by date in ascending order so that we can be sure the latest
     #place of residence is the last one encountered for each ID
-    living.sort_values(inplace=True,by='Start_of_residence',ascending=True)
+    living.sort_values(inplace=True,by='Start_of_residence',ascending=True,kind='stable')
     end = time()
     print('Mangling the data frame took '+str(end-start)+" s")
     print("Living history, number or data rows: "+str(len(living)))
@@ -863,8 +851,7 @@ def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
         living_end = row['End_of_residence']
 
         if params['ByYear']=='F':
-            key = ID
-            for ind in data_ind_dict[key]:
+            for ind in getRows(row_index,ID):
                 fu_end = data.iloc[ind]['end_of_followup']
                 fu_start = data.iloc[ind]['start_of_followup']
                 if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
@@ -886,10 +873,7 @@ def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
             #if living_start is null, only mark residence for the living_end year
             if pd.isnull(living_start): living_start = living_end
             for year in range(living_start.year,living_end.year+1):
-                key = (ID,year)
-                if key not in data_ind_dict: continue
-
-                for ind in data_ind_dict[key]:
+                for ind in getRows(row_index,ID,year):
                     fu_end = data.iloc[ind]['end_of_followup']
                     fu_start = data.iloc[ind]['start_of_followup']
                     if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
@@ -921,7 +905,51 @@ def readLiving(data,params,cpi,requested_features,ID_set,data_ind_dict):
     
     return data
 
-def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def getSESCodes(raw_codes):
+    #Socioeconomic codes are compared using the first two characters of their integer part,
+    #e.g. '31.0' -> '31'. Missing values ('nan') become 'na'.
+    return pd.Series(raw_codes,dtype=str).str.split('.').str[0].str[:2].values
+
+def mapSESCodes(codes,years,code_maps,ses_names):
+    #Map socioeconomic codes to the ses_* variable names using the code table of the era
+    #of each entry: psose before 1990, sose_1990 in 1990-1994 and sose after that.
+    #code_maps = (psose_map,sose_1990_map,sose_map)
+    years = np.asarray(years,dtype=float)
+    status = np.empty(len(codes),dtype=object)
+    eras = [years<1990,~(years<1990) & (years<1995),~(years<1995)]
+    for era,code_map in zip(eras,code_maps):
+        table = {code:ses_names[code_map[code]] for code in set(codes[era])}
+        status[era] = [table[code] for code in codes[era]]
+    return status
+
+def fillSESFromSource(data,params,row_index,IDs,years,raw_codes,code_maps,ses_names):
+    #Fill in the socioeconomic status from a secondary source (social assistance or birth registry).
+    #The entries are matched to data on ID (ByYear=F) or ID and year (ByYear=T) without
+    #checking the follow-up, and the latest entry overwrites the status of every matched row.
+    #Entries from 1990-1994 only update the onset age, not the status itself.
+    years = np.asarray(years,dtype=float)
+    src,ind = matchRecords(data,params,row_index,IDs,years=years,followup=False)
+    codes = getSESCodes(raw_codes)[src]
+    #do not replace a real code with missing value
+    valid = codes!='na'
+    src,ind,codes = src[valid],ind[valid],codes[valid]
+    status = mapSESCodes(codes,years[src],code_maps,ses_names)
+    pairs = np.arange(len(ind))
+
+    sets_status = ~((years[src]>=1990) & (years[src]<1995))
+    rec = lastRecord(pairs[sets_status],ind[sets_status],len(data))
+    ses = data['ses'].values.copy()
+    ses[rec>=0] = status[rec[rec>=0]]
+    data['ses'] = ses
+    if params['OutputAge']=='T':
+        rec = lastRecord(pairs,ind,len(data))
+        OnsetAge = getOnsetAges(data['date_of_birth'].values[ind],yearStart(years[src]))
+        ses_OnsetAge = data['ses_OnsetAge'].values.copy()
+        ses_OnsetAge[rec>=0] = OnsetAge[rec[rec>=0]]
+        data['ses_OnsetAge'] = ses_OnsetAge
+    return data
+
+def readSES(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the socioeconomic status variables from the SF Socioeconomic dataset
     #this function currently creates one variable, which is:
     #ses_self_employed = Socioeconomic status: self-employed
@@ -935,11 +963,8 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     #ses_missing = Socioeconomic status missing
     
     start = time()
-    ses = pd.read_csv(params['SESFile'])
     #keep only rows corresponding to IDs in samples
-    #depending on the version, some source files have some column names in uppercase, some in lowercase
-    if 'FINREGISTRYID' not in ses.columns: ses = ses.rename(columns={'finregistryid':'FINREGISTRYID'})
-    ses = ses[ses['FINREGISTRYID'].isin(ID_set)]
+    ses = readSource(params,'SESFile',ID_set)
     #skip rows with missing year
     print(ses.loc[ses['vuosi'].isnull()])
     ses = ses.loc[~ses['vuosi'].isnull()]
@@ -949,7 +974,7 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     ses['sose'] = ses['sose'].astype(str)
     ses.rename(columns={'vuosi':'year'},inplace=True)
     #sort the values by year to be certain the newest entry for each ID is read in last
-    ses.sort_values(by='year',inplace=True)
+    ses.sort_values(by='year',inplace=True,kind='stable')
     
     print("Socioeconomic status, number or data rows: "+str(len(ses)))
 
@@ -959,76 +984,34 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     #sose maps
     sose_1990_map = {'1':'1','10':'1','11':'1','12':'1','20':'1','2':'1','21':'1','22':'1','23':'1','24':'1','29':'1','3':'3','30':'3','31':'3','32':'3','33':'3','34':'3','39':'3','4':'4','40':'4','41':'4','42':'4','43':'4','44':'4','49':'4','5':'5','50':'5','51':'5','52':'5','53':'5','54':'5','59':'5','6':'7','60':'7','61':'7','7':'7','70':'6','71':'7','72':'7','73':'7','74':'7','79':'7','8':'8','81':'8','82':'8','83':'8','84':'8','85':'8','91':'8','92':'8','93':'8','94':'8','X':'9','9':'9','98':'9','99':'9','na':'NaN'}
     sose_map = {'1':'1','10':'1','11':'1','12':'1','20':'1','2':'1','21':'1','22':'1','23':'1','24':'1','29':'1','3':'3','30':'3','31':'3','32':'3','33':'3','34':'3','39':'3','4':'4','40':'4','41':'4','42':'4','43':'4','44':'4','49':'4','5':'5','50':'5','51':'5','52':'5','53':'5','54':'5','59':'5','6':'7','60':'6','61':'7','7':'7','70':'7','71':'7','72':'7','73':'7','74':'7','79':'7','8':'8','81':'8','82':'8','83':'8','84':'8','85':'8','91':'8','92':'8','93':'8','94':'8','X':'9','9':'9','98':'9','99':'9','na':'NaN'}
+    code_maps = (psose_map,sose_1990_map,sose_map)
     
     #create new columns
     #latest socioeconomic status (within the specified follow-up) for each row in SamplesList
-    ses_status = ['ses_missing' for i in range(len(data))]
+    years = ses['year'].values
+    src,ind = matchRecords(data,params,row_index,ses['FINREGISTRYID'].values,years=years)
+    #the code is psose before 1990 and sose after that
+    codes = getSESCodes(np.where(years<1990,ses['psose'].values,ses['sose'].values))[src]
+    #do not replace a real code with missing value
+    valid = codes!='na'
+    src,ind,codes = src[valid],ind[valid],codes[valid]
+    status = mapSESCodes(codes,years[src],code_maps,ses_names)
+    #the latest valid entry within the follow-up determines the status
+    rec = lastRecord(np.arange(len(ind)),ind,len(data))
+    ses_status = takeRecords(status,rec,'ses_missing')
     #only one variable to capture the onset age
-    ses_OnsetAge = [np.nan for i in range(len(data))]
-    for index,row in ses.iterrows():
-        ID = row['FINREGISTRYID']
-        year = row['year']
-        if params['ByYear']=='T':
-            key = (ID,year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-        
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #skip if year is outside of follow-up for this entry in SamplesList
-            if year<fu_start.year or year>fu_end.year: continue
-            
-            if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
-            old_code = ses_status[ind]
-            
-            if year<1990:
-                #code is psose
-                code = row['psose'].split('.')[0]
-                if len(code)>2: code = code[:2]
-                #do not replace a real code with missing value
-                if code=='na' and ses_status[ind]!='NaN': continue
-                ses_status[ind] = ses_names[psose_map[code]]
-            elif year<1995:
-                #code is sose_1990
-                code = row['sose'].split('.')[0]
-                if len(code)>2: code = code[:2]
-                #do not replace a real code with missing value
-                if code=='na' and ses_status[ind]!='NaN': continue
-                ses_status[ind] = ses_names[sose_1990_map[code]]
-            else:
-                #code is sose
-                code = row['sose'].split('.')[0]
-                if len(code)>2: code = code[:2]
-                #do not replace a real code with missing value
-                if code=='na' and ses_status[ind]!='NaN': continue
-                ses_status[ind] = ses_names[sose_map[code]]
-
-                #print(row)
-                #print(code)
-                #print(ses_status[ind])
-                #while True:
-                #    z = input('any')
-                #    break
-            #if onset age is requested
-            if params['OutputAge']=='T':
-                #if the socioeconomic status did not change from the last record,
-                #then we keep the first occurrence of the same socioeconomic status
-                #as the onset age
-                if old_code!=code:
-                    OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                    ses_OnsetAge[ind] = OnsetAge
+    #if the socioeconomic status did not change from the last record,
+    #then we keep the first occurrence of the same socioeconomic status
+    #as the onset age
+    if params['OutputAge']=='T':
+        OnsetAge = getOnsetAges(data['date_of_birth'].values[ind],yearStart(years[src]))
+        ses_OnsetAge = takeRecords(OnsetAge,rec,np.nan)
     #then add the new columns to dataframe data
     #but first read SES also from Social assistance register and birth register
     #to fill in possibly missing values
-    #print(ses_status)
     data['ses'] = ses_status
-    #print(data['ses'].value_counts())
     #add the onset column if requested
-    if params['OutputAge']=='T':
-        #print('Adding ses_OnsetAge column')
-        data['ses_OnsetAge'] = ses_OnsetAge
-        #print(data.columns)
+    if params['OutputAge']=='T': data['ses_OnsetAge'] = ses_OnsetAge
 
     nan_IDs = set(data.loc[data['ses']=='ses_missing']['FINREGISTRYID'])
     print('Number of missing SESs:')
@@ -1036,62 +1019,11 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     if len(nan_IDs)>0:
         #first social assistance register
         keep_cols = ['FINREGISTRYID','TILASTOVUOSI','SOSIOEKOASEMA']
-        assistance = pd.read_csv(params['SocialAssistanceFile'],usecols=keep_cols,sep=',',dtype={'SOSIOEKOASEMA':str})
         #keep only rows corresponding to IDs with missing SES
-        assistance = assistance[assistance['FINREGISTRYID'].isin(nan_IDs)]
+        assistance = readSource(params,'SocialAssistanceFile',nan_IDs,usecols=keep_cols,sep=',',dtype={'SOSIOEKOASEMA':str})
         #keep only rows with non-missing SOSIOEKOASEMA
         assistance = assistance.loc[~pd.isnull(assistance['SOSIOEKOASEMA'])]
-        #print('SOSIOEKOASEMA from social assistance read in')
-        for index,row in assistance.iterrows():
-            ID = row['FINREGISTRYID']
-            year = row['TILASTOVUOSI']
-            if params['ByYear']=='F': key = ID
-            elif params['ByYear']=='T':
-                key = (ID,year)
-                if key not in data_ind_dict: continue
-            #print(row)
-            for ind in data_ind_dict[key]:
-                #go through with each entry with NaN socioeconomic status and replace if a
-                #value is found from the social assistance register
-                old_code = data.iloc[ind]['ses']
-                dob = data.iloc[ind]['date_of_birth']
-                #print('dob:')
-                #print(dob)
-                #print('year:')
-                #print(year)
-                if year<1990:
-                    #code is psose
-                    code = row['SOSIOEKOASEMA'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    data.at[ind,'ses'] = ses_names[psose_map[code]]
-                elif year<1995:
-                    #code is sose_1990
-                    code = row['SOSIOEKOASEMA'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    ses_status[ind] = ses_names[sose_1990_map[code]]
-                else:
-                    #code is sose
-                    #print(row)
-                    #print('dob:')
-                    #print(dob)
-                    #print('year:')
-                    #print(year)
-                    code = row['SOSIOEKOASEMA'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    data.at[ind,'ses'] = ses_names[sose_map[code]]
-                if params['OutputAge']=='T':
-                    #if the socioeconomic status did not change from the last record,
-                    #then we keep the first occurrence of the same socioeconomic status
-                    #as the onset age
-                    if old_code!=code:
-                        OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                        data.at[ind,'ses_OnsetAge'] = OnsetAge
+        data = fillSESFromSource(data,params,row_index,assistance['FINREGISTRYID'].values,assistance['TILASTOVUOSI'].values,assistance['SOSIOEKOASEMA'].values,code_maps,ses_names)
 
     #If we still have missing values, try to fill them from the birth registry
     nan_IDs = set(data.loc[data['ses']=='ses_missing']['FINREGISTRYID'])
@@ -1100,53 +1032,12 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     if len(nan_IDs)>0:
         #read birth register
         keep_cols = ['AITI_FINREGISTRYID','TILASTOVUOSI','SOSEKO']
-        birth = pd.read_feather(params['BirthFile'],columns=keep_cols)
         #keep only rows corresponding to IDs with missing SES
-        birth = birth[birth['AITI_FINREGISTRYID'].isin(nan_IDs)]
+        birth = readSource(params,'BirthFile',nan_IDs,ID_cols=['AITI_FINREGISTRYID'],usecols=keep_cols)
         #keep only rows with non-missing SOSEKO
         birth = birth.loc[~pd.isnull(birth['SOSEKO'])]
         birth['SOSEKO'] = birth['SOSEKO'].astype(str)
-        #print('SOSEKO from birth registry read in')
-        for index,row in birth.iterrows():
-            ID = row['AITI_FINREGISTRYID']
-            year = row['TILASTOVUOSI']
-            if params['ByYear']=='F': key = ID
-            elif params['ByYear']=='T':
-                key = (ID,year)
-                if key not in data_ind_dict: continue
-            for ind in data_ind_dict[key]:
-                #go through with each entry with NaN socioeconomic status and replace if a
-                #value is found from the birth register
-                old_code = data.iloc[ind]['ses']
-                if year<1990:
-                    #code is psose
-                    code = row['SOSEKO'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    data.at[ind,'ses'] = ses_names[psose_map[code]]
-                elif year<1995:
-                    #code is sose_1990
-                    code = row['SOSEKO'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    ses_status[ind] = ses_names[sose_1990_map[code]]    
-                else:
-                    #code is sose
-                    code = row['SOSEKO'].split('.')[0]
-                    if len(code)>2: code = code[:2]
-                    #do not replace a real code with missing value
-                    if code=='na' and ses_status[ind]!='NaN': continue
-                    #print('code='+str(code))
-                    data.at[ind,'ses'] = ses_names[sose_map[code]]
-                if params['OutputAge']=='T':
-                    #if the socioeconomic status did not change from the last record,
-                    #then we keep the first occurrence of the same socioeconomic status
-                    #as the onset age
-                    if old_code!=code:
-                        OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                        data.at[ind,'ses_OnsetAge'] = OnsetAge
+        data = fillSESFromSource(data,params,row_index,birth['AITI_FINREGISTRYID'].values,birth['TILASTOVUOSI'].values,birth['SOSEKO'].values,code_maps,ses_names)
 
     #print('Number of missing SESs:')
     #print(len(nan_IDs))
@@ -1172,12 +1063,15 @@ def readSES(data,params,cpi,requested_features,ID_set,data_ind_dict):
     data_cols_set = set(data.columns)
     #print(ses_set.difference(data_cols_set))
     for name in ses_set.difference(data_cols_set): data[name] = [0 for i in range(len(data))]
+    #keep the indicator columns always in the same (alphabetical) order, which does not depend
+    #on which levels happen to be present in the samples or in a shard of them
+    data = data[[c for c in data.columns if c not in ses_set]+sorted(ses_set)]
 
     end = time()
     print("Socioeconomic status preprocessed in "+str(end-start)+" s")
     return data
 
-def readEdu(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readEdu(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the education variables from the SF Socioeconomic dataset
     #this function currently creates the following variables:
     #edu_years = Highest completed education in education years
@@ -1196,12 +1090,9 @@ def readEdu(data,params,cpi,requested_features,ID_set,data_ind_dict):
     #edufield_NA = Field of education not found or unknown
     
     start = time()
-    edu = pd.read_csv(params['EducationFile'],usecols=lambda x: x.lower() in ["finregistryid","vuosi","iscfi2013","kaste_t2"],dtype={'iscfi2013':str,'kaste_t2':str},encoding = 'ISO-8859-1')
-    #depending on the version, some source files have some column names in uppercase, some in lowercase
-    if 'FINREGISTRYID' not in edu.columns: edu = edu.rename(columns={'finregistryid':'FINREGISTRYID'})
     #edu = pd.read_csv(params['EducationFile'],usecols=["FINREGISTRYID","vuosi","iscfi2013","kaste_t2"],dtype={'iscfi2013':str,'kaste_t2':str},encoding = 'ISO-8859-1')
     #keep only rows corresponding to IDs in samples
-    edu = edu[edu['FINREGISTRYID'].isin(ID_set)]
+    edu = readSource(params,'EducationFile',ID_set,usecols=lambda x: x.lower() in ["finregistryid","vuosi","iscfi2013","kaste_t2"],dtype={'iscfi2013':str,'kaste_t2':str},encoding = 'ISO-8859-1')
     #for both edulevel and edufield, keep only the first/2 first character of the code
     edu['kaste_t2'] = edu['kaste_t2'].str[0]
     edu['iscfi2013'] = edu['iscfi2013'].str[:2]
@@ -1224,40 +1115,21 @@ def readEdu(data,params,cpi,requested_features,ID_set,data_ind_dict):
     edu['iscfi2013'] = edu['iscfi2013'].map(edu_field_map)
     #print(edu['iscfi2013'].value_counts())
     #create the new variables
-    edu_years = [0.0 for i in range(len(data))]
-    edufield = ['edufield_NA' for i in range(len(data))]
+    #only the entry with the highest education level within the follow-up is used
+    years = edu['vuosi'].dt.year.values
+    src,ind = matchRecords(data,params,row_index,edu['FINREGISTRYID'].values,years=years)
+    rec = maxRecord(src,ind,edu['kaste_t2'].values[src],len(data),0.0)
+    edu_years = takeRecords(edu['kaste_t2'].values,rec,0.0)
+    edufield = takeRecords(edu['iscfi2013'].values,rec,'edufield_NA')
     #possible ages of onset
-    if params['OutputAge']=='T': edufield_OnsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in edu.iterrows():
-        ID = row['FINREGISTRYID']
-        year = row['vuosi'].year
-        #print(year)
-        if params['ByYear']=='T':
-            key = (ID,year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-        
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #skip if year is outside of follow-up for this entry
-            if year<fu_start.year or year>fu_end.year: continue
-            
-            if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
-            old_edulevel = edu_years[ind]
-            edulevel = row['kaste_t2']
-            if edulevel>old_edulevel:
-                #only update edulevel if it is higher than what is recorded previously
-                edu_years[ind] = edulevel
-                edufield[ind] = row['iscfi2013']
-                #if onset age is requested
-                if params['OutputAge']=='T':
-                    #For lower-secondary education we do not have the year available
-                    #so it is set to the population median
-                    if edulevel<18: OnsetAge = getOnsetAge(dob,datetime(dob.year+16,1,1))
-                    else: OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                    edufield_OnsetAge[ind] = OnsetAge
+    if params['OutputAge']=='T':
+        edufield_OnsetAge = np.full(len(data),np.nan)
+        has = rec>=0
+        dob = data['date_of_birth'].values[has]
+        #For lower-secondary education we do not have the year available
+        #so it is set to the population median
+        onset_year = np.where(edu_years[has]<18,pd.DatetimeIndex(dob).year+16,years[rec[has]])
+        edufield_OnsetAge[has] = getOnsetAges(dob,yearStart(onset_year))
     #add the new columns to data
     if 'edu_years' in requested_features: data['edu_years'] = edu_years
     if 'edu_ongoing' in requested_features:
@@ -1281,14 +1153,16 @@ def readEdu(data,params,cpi,requested_features,ID_set,data_ind_dict):
         #print(data.columns)
         data_cols_set = set(data.columns)
         for name in edu_set.difference(data_cols_set): data[name] = [0 for i in range(len(data))]
-        
+        #keep the indicator columns always in the same (alphabetical) order
+        data = data[[c for c in data.columns if c not in edu_set]+sorted(edu_set)]
+
         if params['OutputAge']=='T': data['edufield_OnsetAge'] = edufield_OnsetAge
         #while True:
         #    z = input('any')
         #    break
     return data
 
-def readBirth(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readBirth(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the education variables from the Birth registry
     #this function currently creates the following variables:
     #miscarriages = Number of miscarriages (KESKENMENOJA)
@@ -1341,9 +1215,8 @@ def readBirth(data,params,cpi,requested_features,ID_set,data_ind_dict):
 
     start = time()
     usecols = ['AITI_FINREGISTRYID','TILASTOVUOSI','AITI_IKA','KESKENMENOJA','KESKEYTYKSIA','ULKOPUOLISIA','KUOLLEENASYNT','TUPAKOINTITUNNUS','IVF','TROMBOOSIPROF','ANEMIA','SOKERI_PATOL','EI_LIEVITYSTA','EI_LIEVITYS_TIETOA','KAYNNISTYS','EDISTAMINEN','PUHKAISU','OKSITOSIINI','PROSTAGLANDIINI','ISTUKANIRROITUS','KAAVINTA','OMPELU','GBS_PROFYLAKSIA','AIDIN_ANTIBIOOTTIHOITO','VERENSIIRTO','YMPARILEIKKAUKSEN_AVAUS','KOHDUNPOISTO','EMBOLISAATIO','SYNNYTYSTAPATUNNUS','ETINEN','ISTIRTO','RKOURIS','HARTIADYSTOKIA','ASFYKSIA','SYNTYMATILATUNNUS']
-    birth = pd.read_feather(params['BirthFile'],columns=usecols)
     #keep only rows corresponding to IDs in samples
-    birth = birth[birth['AITI_FINREGISTRYID'].isin(ID_set)]
+    birth = readSource(params,'BirthFile',ID_set,ID_cols=['AITI_FINREGISTRYID'],usecols=usecols)
 
     #rename columns to match the output variable names
     rename_col_dict = {'KESKENMENOJA':'miscarriages','KESKEYTYKSIA':'terminated_pregnancies','ULKOPUOLISIA':'ectopic_pregnancies','KUOLLEENASYNT':'stillborns','IVF':'invitro_fertilization','TROMBOOSIPROF':'thrombosis_prophylaxis','ANEMIA':'anemia','SOKERI_PATOL':'glucose_test_abnormal','EI_LIEVITYSTA':'no_analgesics','EI_LIEVITYS_TIETOA':'analgesics_info_missing','KAYNNISTYS':'initiated_labor','EDISTAMINEN':'promoted_labor','PUHKAISU':'puncture','OKSITOSIINI':'oxytocin','PROSTAGLANDIINI':'prostaglandin','ISTUKANIRROITUS':'extraction_of_placenta','KAAVINTA':'uterine_scraping','OMPELU':'suturing','GBS_PROFYLAKSIA':'prophylaxis','AIDIN_ANTIBIOOTTIHOITO':'mother_antibiotics','VERENSIIRTO':'blood_transfusion','YMPARILEIKKAUKSEN_AVAUS':'circumcision','KOHDUNPOISTO':'hysterectomy','EMBOLISAATIO':'embolisation','ETINEN':'placenta_praevia','ISTIRTO':'ablatio_placentae','RKOURIS':'eclampsia','HARTIADYSTOKIA':'shoulder_dystocia','ASFYKSIA':'asphyxia'}
@@ -1387,32 +1260,14 @@ def readBirth(data,params,cpi,requested_features,ID_set,data_ind_dict):
     for name in birth_set.difference(data_cols_set): birth[name] = [0 for i in range(len(birth))]
         
     #initialize the new columns
+    years = birth['TILASTOVUOSI'].values
+    src,ind = matchRecords(data,params,row_index,birth['AITI_FINREGISTRYID'].values,years=years)
     new_cols = {}
     for cname in birth.columns:
-        if cname not in ['AITI_FINREGISTRYID','TILASTOVUOSI','AITI_IKA']: new_cols[cname] = [0 for i in range(len(data))]
-    if params['OutputAge']=='T': birth_onsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in birth.iterrows():
-        ID = row['AITI_FINREGISTRYID']
-        year = row['TILASTOVUOSI']
-        if params['ByYear']=='T':
-            key = (ID,year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-        
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #skip if year is outside of follow-up for this entry
-            if year<fu_start.year or year>fu_end.year: continue
-
-            for cname in new_cols:
-                #do not overwrite 1s with never 0s
-                #print(cname)
-                #print(birth[cname])
-                if new_cols[cname][ind]<1: new_cols[cname][ind] = row[cname]
-            #check if age at birth is requested
-            if params['OutputAge']=='T': birth_onsetAge[ind] = row['AITI_IKA']
+        #do not overwrite 1s with never 0s
+        if cname not in ['AITI_FINREGISTRYID','TILASTOVUOSI','AITI_IKA']: new_cols[cname] = reduceSticky(src,ind,birth[cname].values[src],len(data))
+    #check if age at birth is requested
+    if params['OutputAge']=='T': birth_onsetAge = takeRecords(birth['AITI_IKA'].values,lastRecord(src,ind,len(data)),np.nan)
     #add the new columns to data
     for cname in new_cols:
         if cname in requested_features: data[cname] = new_cols[cname]
@@ -1424,7 +1279,7 @@ def readBirth(data,params,cpi,requested_features,ID_set,data_ind_dict):
 
     return data
 
-def readLongterm(data,params,cpi,requested_features,ID_set,data_ind_dict):
+def readLongterm(data,params,cpi,requested_features,ID_set,row_index):
     #Read in the long-term care variables from the Social hilmo
     #this function currently creates the following variables:
     #care_in_elderly_home = Type of long-term care: Care in an elderly home (PALA)
@@ -1475,9 +1330,8 @@ def readLongterm(data,params,cpi,requested_features,ID_set,data_ind_dict):
 
     start = time()
     usecols = ['FINREGISTRYID','VUOSI','PALA','TUSYY1','PITK','KVHP']
-    longterm = pd.read_csv(params['SocialHilmoFile'],sep=',',usecols=usecols,dtype={'PALA':str,'TUSYY1':str},encoding = 'ISO-8859-1')
     #keep only rows corresponding to IDs in samples
-    longterm = longterm[longterm['FINREGISTRYID'].isin(ID_set)]
+    longterm = readSource(params,'SocialHilmoFile',ID_set,sep=',',usecols=usecols,dtype={'PALA':str,'TUSYY1':str},encoding = 'ISO-8859-1')
     #preprocess TUSYY1 to harmonize the codes used
     longterm['TUSYY1'] = longterm['TUSYY1'].str.replace('"','',regex=False)
     longterm['TUSYY1'] = longterm['TUSYY1'].str.replace(',','',regex=False)
@@ -1514,38 +1368,18 @@ def readLongterm(data,params,cpi,requested_features,ID_set,data_ind_dict):
     for name in type_set.difference(data_cols_set): longterm[name] = [0 for i in range(len(longterm))]
 
     #initialize the new columns
+    years = longterm['VUOSI'].values
+    src,ind = matchRecords(data,params,row_index,longterm['FINREGISTRYID'].values,years=years)
     new_cols = {}
     for cname in longterm.columns:
-        if cname not in ['FINREGISTRYID','VUOSI']: new_cols[cname] = [0 for i in range(len(data))]
-    if params['OutputAge']=='T': longtermcare_onsetAge = [np.nan for i in range(len(data))]
-
-    for index,row in longterm.iterrows():
-        ID = row['FINREGISTRYID']
-        year = row['VUOSI']
-        if params['ByYear']=='T':
-            key = (ID,year)
-            if key not in data_ind_dict: continue
-        elif params['ByYear']=='F': key = ID
-        
-        for ind in data_ind_dict[key]:
-            fu_end = data.iloc[ind]['end_of_followup']
-            fu_start = data.iloc[ind]['start_of_followup']
-            #skip if year is outside of follow-up for this entry
-            if year<fu_start.year or year>fu_end.year: continue
-
-            if params['OutputAge']=='T': dob = data.iloc[ind]['date_of_birth']
-            for cname in new_cols:
-                if cname=='long_term_care_duration':
-                    new_cols['long_term_care_duration'][ind] += row['long_term_care_duration']
-                else:
-                    #do not overwrite 1s with never 0s
-                    #print(cname)
-                    #print(longterm[cname][ind])
-                    if new_cols[cname][ind]<1: new_cols[cname][ind] = row[cname]
-            #check if age at birth is requested
-            if params['OutputAge']=='T':
-                OnsetAge = getOnsetAge(dob,datetime(year,1,1))
-                longtermcare_onsetAge[ind] = OnsetAge
+        if cname in ['FINREGISTRYID','VUOSI']: continue
+        if cname=='long_term_care_duration': new_cols[cname] = reduceSum(ind,longterm[cname].values[src],len(data))
+        #do not overwrite 1s with never 0s
+        else: new_cols[cname] = reduceSticky(src,ind,longterm[cname].values[src],len(data))
+    #check if age at the latest long-term care entry is requested
+    if params['OutputAge']=='T':
+        OnsetAge = getOnsetAges(data['date_of_birth'].values[ind],yearStart(years[src]))
+        longtermcare_onsetAge = takeRecords(OnsetAge,lastRecord(np.arange(len(ind)),ind,len(data)),np.nan)
     #add the new columns to data
     for cname in new_cols:
         if cname in requested_features: data[cname] = new_cols[cname]
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+
+from perf_report import addCount
+
+#Vectorized matching of source registry records to the rows of the output dataframe
+#and the reductions used by the readers in helpers.py.
+#
+#The readers used to loop over the source with iterrows() and over the rows of
+#each ID for every record. Here the same is done with array operations in two steps:
+#1. matchRecords returns aligned arrays (src,ind) meaning that source record src[k]
+#   contributes to row ind[k] of dataframe data. The pairs are ordered by source
+#   record, so the reductions see the records in the same order as the old loops.
+#2. a reduction (sum, any, min, last, max, sticky) combines the matched records
+#   into one value per row of data.
+
+def buildRowIndex(data,params):
+    #Build the index from FINREGISTRYID (ByYear=F) or (FINREGISTRYID,year) (ByYear=T)
+    #to the rows of dataframe data. This replaces the old data_ind_dict, a dict of
+    #Python lists, with a compact CSR-style structure:
+    #ids = sorted unique IDs, the position of an ID in ids is its integer code
+    #keys = sorted unique keys (ID code, or ID code and year packed into one integer)
+    #offsets = rows of key keys[k] are rows[offsets[k]:offsets[k+1]]
+    #rows = row positions in data, sorted by key and then by position
+    codes,uniques = pd.factorize(data['FINREGISTRYID'],sort=True)
+    by_year = params['ByYear']=='T'
+    if by_year: all_keys = packKeys(codes,data['year'].values)
+    else: all_keys = codes.astype(np.int64)
+    return buildRowIndexFromKeys(uniques,by_year,all_keys)
+
+def buildRowIndexFromKeys(ids,by_year,all_keys):
+    #build the row index from the key of each row of data, see buildRowIndex
+    rows = np.argsort(all_keys,kind='stable')
+    keys,counts = np.unique(all_keys[rows],return_counts=True)
+    offsets = np.zeros(len(keys)+1,dtype=np.int64)
+    np.cumsum(counts,out=offsets[1:])
+    return {'ids':pd.Index(ids),'by_year':by_year,'keys':keys,'offsets':offsets,'rows':rows.astype(np.int32)}
+
+def packKeys(codes,years):
+    #pack ID codes and years into one sortable integer key
+    return (np.asarray(codes,dtype=np.int64)<<16) | np.asarray(years,dtype=np.int64)
+
+def lookupRows(row_index,IDs,years=None):
+    #Vectorized lookup of the rows of data for each source record
+    #returns aligned arrays (src,ind): record src[k] has row ind[k], ordered by record
+    #years are only used with ByYear=T, records with a missing year have no rows
+    codes = row_index['ids'].get_indexer(np.asarray(IDs))
+    found = codes>=0
+    if row_index['by_year']:
+        years = np.asarray(years,dtype=float)
+        found &= ~np.isnan(years)
+        src_keys = packKeys(codes[found],years[found])
+    else: src_keys = codes[found].astype(np.int64)
+    src = np.flatnonzero(found)
+    #find the key of each record
+    keys = row_index['keys']
+    k = np.searchsorted(keys,src_keys).clip(0,max(len(keys)-1,0))
+    if len(keys)>0: hit = keys[k]==src_keys
+    else: hit = np.zeros(len(src_keys),dtype=bool)
+    src,k = src[hit],k[hit]
+    #expand each record to all rows of its key
+    starts = row_index['offsets'][k]
+    counts = row_index['offsets'][k+1]-starts
+    total = counts.sum()
+    pos = np.arange(total)-np.repeat(np.cumsum(counts)-counts,counts)+np.repeat(starts,counts)
+    return np.repeat(src,counts),row_index['rows'][pos].astype(np.int64)
+
+def getRows(row_index,ID,year=None):
+    #Rows of data for a single ID (ByYear=F) or ID and year (ByYear=T), empty if there are none
+    try: code = row_index['ids'].get_loc(ID)
+    except KeyError: return row_index['rows'][:0]
+    if row_index['by_year']:
+        if year is None or pd.isnull(year): return row_index['rows'][:0]
+        key = (code<<16) | int(year)
+    else: key = code
+    keys = row_index['keys']
+    k = np.searchsorted(keys,key)
+    if k==len(keys) or keys[k]!=key: return row_index['rows'][:0]
+    return row_index['rows'][row_index['offsets'][k]:row_index['offsets'][k+1]]
+
+def matchRecords(data,params,row_index,IDs,years=None,dates=None,followup=True):
+    #Match source records to the rows of dataframe data
+    #IDs = FINREGISTRYIDs of the source records
+    #years = year of each record, for yearly sources (e.g. income, SES)
+    #dates = date of each record, for dated sources (e.g. emigration, birth of a child)
+    #With ByYear=F a record is matched to every follow-up window of the ID that contains it,
+    #with ByYear=T to the person-year rows of the ID for the year of the record.
+    #followup=False skips the follow-up check and matches on ID (and year) only.
+    #NOTE: as in the old loops, a record with a missing year/date is not excluded by the
+    #follow-up check, it is only lost with ByYear=T as there is no matching person-year.
+    if dates is not None:
+        dates = np.asarray(dates,dtype='datetime64[ns]')
+        years = pd.DatetimeIndex(dates).year.values.astype(float)
+    else: years = np.asarray(years,dtype=float)
+    src,ind = lookupRows(row_index,IDs,years)
+
+    #keep only records that fall inside the follow-up of the row
+    if not followup: outside = np.zeros(len(src),dtype=bool)
+    elif dates is not None:
+        fu_start = data['start_of_followup'].values[ind]
+        fu_end = data['end_of_followup'].values[ind]
+        outside = (dates[src]<fu_start) | (dates[src]>fu_end)
+    else:
+        fu_start = data['start_of_followup'].dt.year.values[ind]
+        fu_end = data['end_of_followup'].dt.year.values[ind]
+        outside = (years[src]<fu_start) | (years[src]>fu_end)
+    src,ind = src[~outside],ind[~outside]
+    addCount('matched_rows',len(src))
+    return src,ind
+
+def _outDtype(values,matched):
+    #dtype of a column that is initialized with integer zeros and then filled with
+    #matched values, so that the output is formatted the same way as before
+    #(integer columns are written without decimals)
+    if matched and values.dtype.kind in 'fc': return values.dtype
+    elif matched and values.dtype.kind=='O': return object
+    return np.int64
+
+def reduceSum(ind,values,n):
+    #sum of the matched values for each row, 0 for rows without matches
+    #the values are added in source order, so the floating point result is the same
+    #as when adding one record at a time
+    values = np.asarray(values)
+    if len(ind)==0: return np.zeros(n,dtype=np.int64)
+    out = np.bincount(ind,weights=values.astype(float),minlength=n)
+    return out.astype(_outDtype(values,True))
+
+def reduceAny(ind,flags,n):
+    #1 for rows with at least one matched record with flag set, 0 otherwise
+    out = np.zeros(n,dtype=np.int64)
+    out[ind[np.asarray(flags,dtype=bool)]] = 1
+    return out
+
+def reduceMin(ind,values,n):
+    #smallest matched value for each row ignoring missing values, NaN if there is none
+    #used for the first onset ages
+    out = np.full(n,np.nan)
+    np.fmin.at(out,ind,np.asarray(values,dtype=float))
+    return out
+
+def lastRecord(src,ind,n):
+    #position of the last matched source record for each row, -1 if there is none
+    rec = np.full(n,-1,dtype=np.int64)
+    if len(ind)==0: return rec
+    rev_ind = ind[::-1]
+    rows,first = np.unique(rev_ind,return_index=True)
+    rec[rows] = src[::-1][first]
+    return rec
+
+def maxRecord(src,ind,values,n,floor):
+    #position of the matched source record with the largest value for each row, -1 if
+    #no value is larger than floor. Ties are resolved to the first record, i.e. a later
+    #record only replaces the current one if its value is strictly larger.
+    rec = np.full(n,-1,dtype=np.int64)
+    values = np.asarray(values,dtype=float)
+    valid = values>floor
+    src,ind,values = src[valid],ind[valid],values[valid]
+    if len(ind)==0: return rec
+    order = np.lexsort((src,-values,ind))
+    rows,first = np.unique(ind[order],return_index=True)
+    rec[rows] = src[order][first]
+    return rec
+
+def reduceSticky(src,ind,values,n):
+    #value for each row when the matched records are written one after another but a
+    #value that is not below 1 (or a missing value) is never overwritten, 0 if there are
+    #no matches. For indicator columns this is the same as the maximum.
+    values = np.asarray(values)
+    out = np.zeros(n,dtype=_outDtype(values,len(ind)>0))
+    if len(ind)==0: return out
+    last = lastRecord(np.arange(len(ind)),ind,n)
+    has = last>=0
+    out[has] = values[last[has]]
+    with np.errstate(invalid='ignore'): sticky = ~(values.astype(float)<1)
+    rows,first = np.unique(ind[sticky],return_index=True)
+    out[rows] = values[sticky][first]
+    return out
+
+def takeRecords(values,rec,fill):
+    #gather values[rec] for each row, fill for rows without a record (rec==-1)
+    values = np.asarray(values)
+    has = rec>=0
+    if values.dtype.kind in 'fc' or values.dtype.kind=='O': out = np.full(len(rec),fill,dtype=values.dtype)
+    else: out = np.full(len(rec),fill,dtype=float if pd.isnull(fill) else values.dtype)
+    out[has] = values[rec[has]]
+    return out
+
+def yearStart(years):
+    #datetime64 array of January 1st of the given years, NaT for missing years
+    years = np.asarray(years,dtype=float)
+    out = np.full(len(years),np.datetime64('NaT'),dtype='datetime64[ns]')
+    ok = ~np.isnan(years)
+    out[ok] = (years[ok].astype(np.int64)-1970).astype('datetime64[Y]').astype('datetime64[ns]')
+    return out
+
+def getOnsetAges(dobs,dates):
+    #vectorized version of helpers.getOnsetAge
+    #returns age of onset in decimal years (whole days/365) for each pair of
+    #date of birth and date of onset, NaN if either is missing
+    dobs = np.asarray(dobs,dtype='datetime64[ns]')
+    dates = np.asarray(dates,dtype='datetime64[ns]')
+    ok = ~(np.isnat(dobs) | np.isnat(dates))
+    ages = np.full(len(dates),np.nan)
+    ages[ok] = ((dates[ok]-dobs[ok])//np.timedelta64(1,'D'))/365.0
+    return ages
+
+def getCPIFactors(cpi,years):
+    #consumer price index correction for each year
+    #if year is not in the cpi table, use the index for year 1972
+    keys = np.array(sorted(cpi),dtype=float)
+    factors = np.array([cpi[k] for k in sorted(cpi)])
+    years = np.asarray(years,dtype=float)
+    pos = np.searchsorted(keys,years).clip(0,len(keys)-1)
+    return np.where(keys[pos]==years,factors[pos],cpi[1972])
@@ -0,0 +1,79 @@
+import os
+import json
+import cProfile
+
+from time import time,process_time
+from datetime import datetime
+
+try: import resource
+except ImportError: resource = None
+
+#Per-stage performance report of MakeRegFile.
+#
+#Each stage of a run (reading the samples, each data source, writing the output) is
+#wrapped with startStage/endStage, which record for the stage:
+#wall_time_s = elapsed time in seconds
+#cpu_time_s = CPU time used by the process running the stage in seconds
+#rows_read = rows read from the source files before the ID filter
+#rows_kept = rows kept after the ID filter
+#matched_rows = source records matched to rows of the output (record,row pairs)
+#peak_rss_mb = peak resident memory of the process running the stage at the end of the stage
+#The row counts are added up by the readers with addCount while the stage is running.
+#Stages run in worker processes return their entry to the main process, which writes
+#all entries to the json file params['OutputFile']+'-perf.json'.
+#With params['ProfileStages']=='T' each stage is also run under cProfile and the
+#statistics are saved to params['OutputFile']+'-profile-<stage>.prof'.
+
+#counters of the stage running in this process
+_counts = {}
+
+def startStage(params,name):
+    #start recording stage name, returns the state passed to endStage
+    _counts.clear()
+    stage = {'name':name,'wall':time(),'cpu':process_time(),'profiler':None}
+    if params.get('ProfileStages','F')=='T':
+        stage['profiler'] = cProfile.Profile()
+        stage['profiler'].enable()
+    return stage
+
+def addCount(key,n):
+    #add n to counter key (rows_read, rows_kept, matched_rows) of the running stage
+    _counts[key] = _counts.get(key,0)+int(n)
+
+def endStage(params,stage):
+    #stop recording the stage and return its entry for the report
+    if stage['profiler'] is not None:
+        stage['profiler'].disable()
+        stage['profiler'].dump_stats(getProfilePath(params,stage['name']))
+    entry = {'name':stage['name'],
+             'wall_time_s':time()-stage['wall'],
+             'cpu_time_s':process_time()-stage['cpu'],
+             'rows_read':_counts.get('rows_read'),
+             'rows_kept':_counts.get('rows_kept'),
+             'matched_rows':_counts.get('matched_rows'),
+             'peak_rss_mb':getPeakRSS(),
+             'pid':os.getpid()}
+    _counts.clear()
+    return entry
+
+def getPeakRSS():
+    #peak resident memory of this process in MB, None if not available on this platform
+    if resource is None: return None
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def getProfilePath(params,name):
+    #path of the cProfile statistics of stage name
+    return params['OutputFile']+'-profile-'+name.lower().replace(' ','_').replace('-','_')+'.prof'
+
+def writeReport(params,stages,total_time):
+    #write the performance report of the run to params['OutputFile']+'-perf.json'
+    #returns the path of the report
+    outname = params['OutputFile']+'-perf.json'
+    report = {'created':datetime.now().isoformat(),
+              'total_wall_time_s':total_time,
+              'peak_rss_mb':getPeakRSS(),
+              'params':params,
+              'stages':stages}
+    with open(outname,'wt') as outfile: json.dump(report,outfile,indent=1)
+    return outname
@@ -0,0 +1,238 @@
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from time import time
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from perf_report import startStage,endStage
+from join_engine import buildRowIndex
+from helpers import readSocialAssistance,readBenefits,readIncome,readPension,readMaritalStatus,readPedigree,readLiving,readSES,readEdu,readBirth,readLongterm,readEmigration
+
+#Scheduling of the data source readers of MakeRegFile.
+#
+#Each reader adds its own columns to dataframe data and does not use the columns added
+#by the other readers, except for total_income, which is the sum of pension (readPension),
+#labor income (readIncome) and social assistance (readSocialAssistance). total_income is
+#therefore modelled as a reduction: each of the three readers computes its own share
+#of the column and the shares are added up in the order pension, income, social assistance
+#when the outputs of the readers are merged. With this, all the readers are independent of
+#each other and can run in any order or in parallel in a pool of worker processes.
+#The merged output is the same as when running the readers one after another.
+#
+#For large sample sets the samples can also be split into params['Shards'] shards by
+#FINREGISTRYID (see runShards). Each shard runs all the readers for its own IDs in a
+#separate worker process, so each process only keeps the source records of its own IDs,
+#and the columns of the shards are merged back in the original row order.
+
+#columns that several readers contribute to, and how the contributions are combined
+REDUCTIONS = {'total_income':'sum'}
+
+#name = name of the data source used in the log messages
+#read = reader function
+#cpi = whether the reader takes the consumer price index table
+#files = source files of the reader, used to start the largest sources first
+#features = reader is skipped if none of these features are requested
+#reduces = reduction columns the reader contributes to
+READERS = [
+    {'name':'Pension','read':readPension,'cpi':True,'files':['PensionFile'],
+     'features':set(['received_disability_pension','received_pension','total_income','total_pension']),
+     'reduces':['total_income']},
+    {'name':'Income','read':readIncome,'cpi':False,'files':['IncomeFile'],
+     'features':set(['total_income','received_labor_income','total_labor_income']),
+     'reduces':['total_income']},
+    {'name':'Benefits','read':readBenefits,'cpi':False,'files':['BenefitsFile'],
+     'features':set(['received_unemployment_allowance','received_study_allowance',
+                     'received_sickness_allowance','received_basic_unemployment_allowance',
+                     'received_maternity_paternity_parental_allowance']),
+     'reduces':[]},
+    {'name':'Social assistance','read':readSocialAssistance,'cpi':True,'files':['SocialAssistanceFile'],
+     'features':set(['total_income','received_any_income_support','total_benefits']),
+     'reduces':['total_income']},
+    {'name':'Emigration','read':readEmigration,'cpi':True,'files':['RelativesFile'],
+     'features':set(['emigrated']),
+     'reduces':[]},
+    {'name':'Marital status','read':readMaritalStatus,'cpi':True,'files':['MarriageHistoryFile'],
+     'features':set(['divorced','married']),
+     'reduces':[]},
+    {'name':'Pedigree','read':readPedigree,'cpi':True,'files':['PedigreeFile'],
+     'features':set(['children']),
+     'reduces':[]},
+    {'name':'Place of residence','read':readLiving,'cpi':True,'files':['LivingExtendedFile'],
+     'features':set(['zip_code','urbanization_class','urban_rural_class_code','sparse_small_house_area','apartment_building_area','small_house_area','demographic_dependency_ratio','economic_dependency_ratio','general_at_risk_of_poverty_rate_for_the_municipality','intermunicipal_net_migration_1000_inhabitants','sale_of_alcoholic_beverages_per_capita','self_rated_health_moderate_or_poor_scaled_health_and_welfare_indicator','average_income_of_inhabitants','median_income_of_inhabitants','permanent_residents_fraction']),
+     'reduces':[]},
+    {'name':'Socioeconomic status','read':readSES,'cpi':True,'files':['SESFile','SocialAssistanceFile','BirthFile'],
+     'features':set(['ses_self_employed','ses_upperlevel','ses_lowerlevel','ses_manual_workers','ses_students','ses_pensioners','ses_others','ses_unknown','ses_missing']),
+     'reduces':[]},
+    {'name':'Education','read':readEdu,'cpi':True,'files':['EducationFile'],
+     'features':set(['edu_years','edu_ongoing','edufield_generic','edufield_education','edufield_artshum','edufield_socialsciences','edufield_businessadminlaw','edufield_science_math_stat','edufield_ict','edufield_engineering','edufield_agriculture','edufield_health','edufield_services','edufield_NA']),
+     'reduces':[]},
+    {'name':'Birth','read':readBirth,'cpi':True,'files':['BirthFile'],
+     'features':set(['miscarriages','terminated_pregnancies','ectopic_pregnancies','stillborns','no_smoking_during_pregnancy','quit_smoking_during_1st_trimester','smoked_after_1st_trimester','smoking_during_pregnancy_NA','invitro_fertilization','thrombosis_prophylaxis','anemia','glucose_test_abnormal','no_analgesics','analgesics_info_missing','initiated_labor','promoted_labor','puncture','oxytocin','prostaglandin','extraction_of_placenta','uterine_scraping','suturing','prophylaxis','mother_antibiotics','blood_transfusion','circumcision','hysterectomy','embolisation','vaginal_delivery','vaginal_delivery_breech','forceps_delivery','vacuum_delivery','planned_c_section','urgent_c_section','emergency_c_section','not_planned_c_section','mode_of_delivery_NA','placenta_praevia','ablatio_placentae','eclampsia','shoulder_dystocia','asphyxia','live_born','stillborn_before_delivery','stillborn_during_delivery','stillborn_unknown','birth_status_NA']),
+     'reduces':[]},
+    {'name':'Long-term care','read':readLongterm,'cpi':True,'files':['SocialHilmoFile'],
+     'features':set(['care_in_elderly_home','assisted_living_elderly','institutional_care_demented','enhanced_care_demented','institutionalized_intellectual_disability','assisted_intellectual_disability','instructed_intellectual_disability','supported_intellectual_disability','services_fos_substance_abusers','rehabilitation','residential_care_housing','psychiatric_residential_care_housing','247_residential_care_housing_under_65yo','247_psychiatric_residential_care','unknown_long_term_care','mr_physical_reasons','mr_insufficient_self_care','mr_deficient_locomotion','mr_nervous_system','mr_forgetfullness','mr_mental_confusion','mr_deficiencies_in_communication','mr_dementia','mr_psychic_social_reasons','mr_depression','mr_other_psychatric','mr_loneliness_insecurity','mr_difficulties_with_housing','mr_lack_of_help_from_family','mr_caretaker_vacation','mr_lack_of_services','mr_lack_of_place_of_care','mr_rehabilitation','mr_med_rehabilitation','mr_accident','mr_somatic','mr_alcohol_use','mr_drug_use','mr_med_abuse','mr_polysubstance_abuse','mr_other_addiction','mr_substance_use_family','mr_NA','long_term_care_decision','long_term_care_duration']),
+     'reduces':[]}
+]
+
+#state shared by the worker processes, set once per worker by initWorker
+_shared = {}
+#state shared by the shard worker processes, set once per worker by initShardWorker
+_shards = {}
+
+def initWorker(data,params,cpi,requested_features,ID_set,row_index):
+    #store the inputs common to all readers in the worker process
+    _shared['args'] = (data,params,cpi,requested_features,ID_set,row_index)
+
+def runReader(i):
+    #Run reader READERS[i] on a copy of dataframe data and return only the columns it added,
+    #including its share of the reduction columns it contributes to, and the performance
+    #report entry of the reader
+    data,params,cpi,requested_features,ID_set,row_index = _shared['args']
+    reader = READERS[i]
+    stage = startStage(params,reader['name'])
+    out = data.copy()
+    #the reduction columns start from zero, so that the reader returns only its own share
+    for col in reader['reduces']:
+        if col in requested_features and col not in out.columns: out[col] = [0 for k in range(len(out))]
+    if reader['cpi']: out = reader['read'](out,params,cpi,requested_features,ID_set,row_index)
+    else: out = reader['read'](out,params,requested_features,ID_set,row_index)
+    new_cols = [c for c in out.columns if c not in data.columns]
+    out = out[new_cols]
+    return out,endStage(params,stage)
+
+def mergeColumns(data,new_data):
+    #Add the columns returned by one reader to dataframe data
+    #a reduction column already in data is combined with the new share, other columns are added
+    cols = {}
+    for col in new_data.columns:
+        if col in REDUCTIONS and col in data.columns:
+            if REDUCTIONS[col]=='sum': data[col] = data[col].add(new_data[col],axis='index')
+        else: cols[col] = new_data[col]
+    if len(cols)>0: data = pd.concat([data,pd.DataFrame(cols,index=data.index)],axis=1)
+    return data
+
+def getSourceSize(params,reader):
+    #total size of the source files of a reader in bytes, 0 if the size cannot be determined
+    size = 0
+    for key in reader['files']:
+        if key in params and os.path.isfile(params[key]): size += os.path.getsize(params[key])
+    return size
+
+def runReaders(data,params,cpi,requested_features,ID_set,row_index):
+    #Run all readers that have requested features and merge their outputs to dataframe data.
+    #With params['Processes']>1 the readers run in a pool of that many worker processes,
+    #the largest sources are started first. Otherwise the readers run one after another.
+    #Returns data and the performance report entries of the readers (see perf_report.py).
+    start = time()
+    todo = []
+    for i in range(len(READERS)):
+        reader = READERS[i]
+        if len(requested_features.intersection(reader['features']))>0: todo.append(i)
+        else: logging.info(reader['name']+' data not read as no '+reader['name'].lower()+'-related features were requested.')
+    nproc = min(int(params.get('Processes',1)),len(todo))
+
+    results = {}
+    stages = {}
+    if nproc>1:
+        #start the largest sources first so that the slowest reader does not start last
+        order = sorted(todo,key=lambda i: getSourceSize(params,READERS[i]),reverse=True)
+        #with fork the workers inherit the inputs without copying them through pickling
+        if 'fork' in multiprocessing.get_all_start_methods(): context = multiprocessing.get_context('fork')
+        else: context = multiprocessing.get_context()
+        with ProcessPoolExecutor(max_workers=nproc,mp_context=context,initializer=initWorker,initargs=(data,params,cpi,requested_features,ID_set,row_index)) as pool:
+            futures = {pool.submit(runReader,i):i for i in order}
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i],stages[i] = future.result()
+                logging.info(READERS[i]['name']+' data read in.')
+    else:
+        initWorker(data,params,cpi,requested_features,ID_set,row_index)
+        for i in todo:
+            results[i],stages[i] = runReader(i)
+            logging.info(READERS[i]['name']+' data read in.')
+        _shared.clear()
+
+    #merge in the original reader order so that the column order and the order of
+    #additions in the reduction columns do not depend on the scheduling
+    for i in todo: data = mergeColumns(data,results[i])
+    end = time()
+    print("All data sources read in in "+str(end-start)+" s")
+    return data,[stages[i] for i in todo]
+
+def splitShards(data,nshards):
+    #Split the rows of dataframe data into at most nshards shards by FINREGISTRYID
+    #the sorted unique IDs are cut into ranges of equal size, so all rows of an ID are in
+    #the same shard. Returns a list of arrays of row positions, empty shards are left out.
+    codes,uniques = pd.factorize(data['FINREGISTRYID'],sort=True)
+    if len(uniques)==0: return []
+    shard = codes.astype(np.int64)*nshards//len(uniques)
+    order = np.argsort(shard,kind='stable')
+    bounds = np.searchsorted(shard[order],np.arange(nshards+1))
+    return [order[bounds[k]:bounds[k+1]] for k in range(nshards) if bounds[k+1]>bounds[k]]
+
+def initShardWorker(data,params,cpi,requested_features,shards):
+    #store the inputs common to all shards in the worker process
+    _shards['args'] = (data,params,cpi,requested_features,shards)
+
+def runShard(k):
+    #Run all readers for the rows of shard k, reading from the sources only the records
+    #of the IDs of the shard. Returns the columns added by the readers, indexed by the
+    #positions of the rows in dataframe data, and the performance report entries.
+    data,params,cpi,requested_features,shards = _shards['args']
+    shard_data = data.iloc[shards[k]].reset_index(drop=True)
+    if isinstance(shard_data['FINREGISTRYID'].dtype,pd.CategoricalDtype):
+        shard_data['FINREGISTRYID'] = shard_data['FINREGISTRYID'].cat.remove_unused_categories()
+    ID_set = set(shard_data['FINREGISTRYID'])
+    row_index = buildRowIndex(shard_data,params)
+    #the readers of a shard run one after another in the shard worker, and the profiles
+    #of the stages are saved separately for each shard
+    shard_params = dict(params)
+    shard_params['Processes'] = '1'
+    shard_params['OutputFile'] = params['OutputFile']+'-shard'+str(k)
+    shard_data,stages = runReaders(shard_data,shard_params,cpi,requested_features,ID_set,row_index)
+    new_cols = [c for c in shard_data.columns if c not in data.columns]
+    out = shard_data[new_cols]
+    out.index = shards[k]
+    for stage in stages: stage['shard'] = k
+    return out,stages
+
+def runShards(data,params,cpi,requested_features):
+    #Run all readers separately for params['Shards'] shards of the samples and merge the
+    #columns of the shards into dataframe data in the original row order.
+    #The shards run in a pool of params['Processes'] worker processes (by default one
+    #process per shard). Returns data and the performance report entries of all shards.
+    start = time()
+    shards = splitShards(data,int(params['Shards']))
+    nproc = min(int(params.get('Processes',len(shards))),len(shards))
+    print("Samples split into "+str(len(shards))+" shards, running in "+str(nproc)+" processes")
+    logging.info("Samples split into "+str(len(shards))+" shards.")
+
+    results = {}
+    stages = {}
+    if nproc>1:
+        if 'fork' in multiprocessing.get_all_start_methods(): context = multiprocessing.get_context('fork')
+        else: context = multiprocessing.get_context()
+        with ProcessPoolExecutor(max_workers=nproc,mp_context=context,initializer=initShardWorker,initargs=(data,params,cpi,requested_features,shards)) as pool:
+            futures = {pool.submit(runShard,k):k for k in range(len(shards))}
+            for future in as_completed(futures):
+                k = futures[future]
+                results[k],stages[k] = future.result()
+                logging.info('Shard '+str(k)+' read in.')
+    else:
+        initShardWorker(data,params,cpi,requested_features,shards)
+        for k in range(len(shards)):
+            results[k],stages[k] = runShard(k)
+            logging.info('Shard '+str(k)+' read in.')
+        _shards.clear()
+
+    #put the rows of the shards back to the original order
+    if len(shards)>0:
+        new_data = pd.concat([results[k] for k in range(len(shards))],axis=0).sort_index()
+        new_data.index = data.index
+        data = pd.concat([data,new_data],axis=1)
+    end = time()
+    print("All shards read in in "+str(end-start)+" s")
+    return data,[stage for k in range(len(shards)) for stage in stages[k]]
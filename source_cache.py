@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from time import time
+
+#On-disk cache of the parsed source registry tables used by MakeRegFile.
+#
+#The first run against a registry file parses it (csv or feather), keeps only the
+#requested columns, converts the date columns to datetime and stores the result under
+#params['CacheDir'] as feather files, one file per chunk when params['ChunkSize'] is set.
+#Later runs read the feather files instead of parsing the source again.
+#The cached tables are not filtered to the samples, so the same cache can be used with
+#any SampleFile.
+#
+#Each cache entry is a directory named by the hash of the source path, the columns and
+#the read options, and depending on params['CacheValidation'] also the size and the
+#modification time of the source file:
+#mtime = the entry is rebuilt if the size or modification time of the source changes (default)
+#size = the entry is rebuilt only if the size of the source changes
+#none = the entry is used as long as it exists
+#An entry that is rebuilt replaces the older entries for the same source and columns.
+#If params['CacheMaxSize'] (in GB) is set, the least recently used entries are removed
+#after writing a new entry until the cache is below that size.
+#params['CacheRefresh']=='T' rebuilds the entries of the sources read in this run.
+
+def getCacheKey(params,path,columns,dates,kwargs):
+    #return (key of the cache entry, key of the source and columns without the file state)
+    family = {'path':os.path.abspath(path),'columns':columns,'dates':list(dates),
+              'chunksize':int(params.get('ChunkSize',0)),
+              'options':{k:kwargs[k] for k in sorted(kwargs) if k!='usecols'}}
+    family = json.dumps(family,sort_keys=True,default=str)
+    validation = params.get('CacheValidation','mtime')
+    stat = os.stat(path)
+    if validation=='mtime': state = [stat.st_size,stat.st_mtime_ns]
+    elif validation=='size': state = [stat.st_size]
+    else: state = []
+    family_key = hashlib.sha1(family.encode()).hexdigest()
+    key = hashlib.sha1((family+json.dumps(state)).encode()).hexdigest()
+    return key,family_key
+
+def getEntryPath(params,key):
+    #path of the cache entry directory
+    return os.path.join(params['CacheDir'],key)
+
+def readCacheEntry(entry):
+    #yield the cached chunks of a cache entry, None if the entry does not exist
+    meta_file = os.path.join(entry,'meta.json')
+    if not os.path.isfile(meta_file): return None
+    with open(meta_file,'rt') as infile: meta = json.load(infile)
+    #mark the entry as recently used for the eviction
+    os.utime(meta_file)
+    return (readCachedChunk(os.path.join(entry,name)) for name in meta['parts'])
+
+def readCachedChunk(path):
+    #read in one cached chunk
+    chunk = feather.read_table(path).to_pandas()
+    #missing values of string columns are read in as None, convert them back to NaN
+    for col in chunk.columns:
+        if chunk[col].dtype==object: chunk[col] = chunk[col].where(chunk[col].notna(),np.nan)
+    return chunk
+
+def openCacheEntry(params,key,family_key,path):
+    #Start writing the chunks of one source into a new cache entry.
+    #The chunks are first written into a temporary directory, which is moved in place by
+    #closeCacheEntry, so that an interrupted run never leaves a partial entry behind.
+    entry = getEntryPath(params,key)
+    writer = {'entry':entry,'tmp':entry+'.tmp'+str(os.getpid()),'ok':True,
+              'meta':{'source':os.path.abspath(path),'family':family_key,'parts':[],'created':time()}}
+    os.makedirs(writer['tmp'],exist_ok=True)
+    return writer
+
+def writeCacheChunk(writer,chunk):
+    #add one chunk to the cache entry
+    if not writer['ok']: return
+    name = 'part-'+str(len(writer['meta']['parts'])).zfill(5)+'.feather'
+    try: feather.write_feather(chunk,os.path.join(writer['tmp'],name))
+    except (pa.ArrowInvalid,pa.ArrowTypeError,pa.ArrowNotImplementedError) as e:
+        #e.g. columns with mixed value types cannot be stored, the source is then not cached
+        print("Source "+writer['meta']['source']+" could not be cached: "+str(e))
+        writer['ok'] = False
+        return
+    writer['meta']['parts'].append(name)
+
+def closeCacheEntry(params,writer):
+    #move the cache entry in place, or remove it if some chunk could not be written
+    if not writer['ok']:
+        shutil.rmtree(writer['tmp'],ignore_errors=True)
+        return
+    with open(os.path.join(writer['tmp'],'meta.json'),'wt') as outfile: json.dump(writer['meta'],outfile)
+    shutil.rmtree(writer['entry'],ignore_errors=True)
+    try: os.rename(writer['tmp'],writer['entry'])
+    except OSError:
+        #another process wrote the same entry at the same time
+        shutil.rmtree(writer['tmp'],ignore_errors=True)
+        return
+    key = os.path.basename(writer['entry'])
+    removeStaleEntries(params,writer['meta']['family'],key)
+    evictEntries(params,key)
+
+def listEntries(params):
+    #return list of (key,meta,size in bytes,last use time) of all complete cache entries
+    entries = []
+    for key in os.listdir(params['CacheDir']):
+        meta_file = os.path.join(params['CacheDir'],key,'meta.json')
+        if not os.path.isfile(meta_file): continue
+        with open(meta_file,'rt') as infile: meta = json.load(infile)
+        size = sum([os.path.getsize(os.path.join(params['CacheDir'],key,name)) for name in meta['parts']])
+        entries.append((key,meta,size,os.path.getmtime(meta_file)))
+    return entries
+
+def removeStaleEntries(params,family_key,keep_key):
+    #remove the entries of older versions of the same source and columns
+    for key,meta,size,used in listEntries(params):
+        if key!=keep_key and meta['family']==family_key: shutil.rmtree(getEntryPath(params,key),ignore_errors=True)
+
+def evictEntries(params,keep_key):
+    #remove the least recently used entries until the cache is below params['CacheMaxSize'] GB
+    if 'CacheMaxSize' not in params: return
+    max_size = float(params['CacheMaxSize'])*1024**3
+    entries = sorted(listEntries(params),key=lambda x: x[3])
+    total = sum([x[2] for x in entries])
+    for key,meta,size,used in entries:
+        if total<=max_size: break
+        if key==keep_key: continue
+        shutil.rmtree(getEntryPath(params,key),ignore_errors=True)
+        total -= size